@@ -1,117 +1,2555 @@
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
-import yt_dlp
 import os
 import uuid
 import requests
 import threading
 import time
-from datetime import datetime, timedelta
+import copy
+import functools
+import gzip
+import mimetypes
+import hashlib
+import heapq
+import hmac
+import json
+import math
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import zipfile
+from collections import deque
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote, urljoin, urlsplit, urlunsplit
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process is its own janitor and pins are process-local
+    fcntl = None
 
 app = Flask(__name__)
 CORS(app)
 
 # Configuration
 DOWNLOAD_DIR = 'downloads'
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+TEMP_DIR = os.path.join(DOWNLOAD_DIR, '.tmp')  # In-progress downloads, never served
+STATE_DIR = os.path.join(DOWNLOAD_DIR, '.state')  # Local state files, never served
+os.makedirs(TEMP_DIR, exist_ok=True)
+os.makedirs(STATE_DIR, exist_ok=True)
+
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 4))  # Concurrent download/transcode jobs per process
+PLAYLIST_WORKERS = int(os.environ.get('PLAYLIST_WORKERS', 4))  # Concurrent tracks across all playlists
+PLAYLIST_MAX_TRACKS = int(os.environ.get('PLAYLIST_MAX_TRACKS', 200))
+BATCH_MAX_URLS = int(os.environ.get('BATCH_MAX_URLS', 500))
+CLIENT_CONCURRENCY = int(os.environ.get('CLIENT_CONCURRENCY', 2))  # Batch jobs one client may run at once
+CLIENT_QUEUE = int(os.environ.get('CLIENT_QUEUE', BATCH_MAX_URLS))  # Batch jobs one client may have waiting
+PLAYLIST_CONCURRENCY = int(os.environ.get('PLAYLIST_CONCURRENCY', 4))  # Tracks of one playlist on the pool at once
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3))  # 2 GB of cached tracks
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', 300))  # Seconds; signed stream URLs expire
+COVER_INDEX_TTL = int(os.environ.get('COVER_INDEX_TTL', 7 * 24 * 3600))  # Seconds a cover URL stays mapped to its file
+STREAM_TEE_TO_CACHE = os.environ.get('STREAM_TEE_TO_CACHE', '1') == '1'  # Keep finished streams
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+STREAM_CHUNK_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 0.5  # Seconds between progress updates published for a job
+SSE_KEEPALIVE = 15  # Seconds between keepalive comments on idle event streams
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))  # Keep-alive connections per host
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 16))  # Threads for network-bound side fetches such as cover art
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', 8))  # HLS segments fetched ahead per download
+FRAGMENT_RETRIES = int(os.environ.get('FRAGMENT_RETRIES', 3))  # Extra attempts per HLS segment before giving up
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 3))  # Extra attempts after a transient upstream error
+RETRY_BASE_DELAY = 0.5  # Seconds; the backoff cap doubles with every attempt
+RETRY_MAX_DELAY = 10
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 8))  # Consecutive upstream failures that open the circuit
+BREAKER_COOLDOWN = int(os.environ.get('BREAKER_COOLDOWN', 30))  # Seconds the circuit stays open before a trial call
+BREAKER_TRIAL = int(os.environ.get('BREAKER_TRIAL', 5))  # Seconds a trial call holds back others before another may try
+COVER_SIZE = os.environ.get('COVER_SIZE', 't500x500')  # SoundCloud artwork variant: large, t500x500 or original
+FILE_MAX_AGE = int(os.environ.get('FILE_MAX_AGE', 30 * 24 * 3600))  # Cache-Control max-age for served artifacts
+INDEX_MAX_AGE = int(os.environ.get('INDEX_MAX_AGE', 300))  # Cache-Control max-age for the landing page
+# How file bytes leave the process: 'sendfile' (WSGI file_wrapper; gunicorn uses os.sendfile),
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd)
+SERVE_MODE = os.environ.get('SERVE_MODE', 'sendfile')
+ACCEL_REDIRECT_PREFIX = os.environ.get('ACCEL_REDIRECT_PREFIX', '/protected-downloads')  # nginx internal location
+# Where job status, the cache index and in-flight locks live: 'memory' (this process only),
+# 'sqlite' (every worker on the host) or 'redis' (every node)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_SQLITE_PATH = os.environ.get('STATE_SQLITE_PATH', os.path.join(STATE_DIR, 'state.sqlite3'))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+STATE_POLL_INTERVAL = 1.0  # Seconds between re-reads of jobs another process may be updating
+STATE_LOCK_TTL = int(os.environ.get('STATE_LOCK_TTL', 900))  # A dead lock holder is given up on after this
+WORKER_HEARTBEAT = int(os.environ.get('WORKER_HEARTBEAT', 10))  # Seconds between liveness writes to a shared store
+WORKER_TIMEOUT = WORKER_HEARTBEAT * 3  # A worker silent this long is dead, and its unfinished jobs fail
+JANITOR_POLL_INTERVAL = 1.0  # Seconds between checks of the journal for other workers' additions
+JANITOR_ELECTION_INTERVAL = 30  # Seconds between attempts to take over from a dead janitor
+JANITOR_RESCAN = int(os.environ.get('JANITOR_RESCAN', 3600))  # Seconds between full directory scans
+FFMPEG_SLOTS = int(os.environ.get('FFMPEG_SLOTS', os.cpu_count() or 2))  # FFmpeg passes run at once by jobs
+# More tracks than FFmpeg slots, so the next downloads overlap running passes
+TRANSCODE_SLOTS = int(os.environ.get('TRANSCODE_SLOTS', FFMPEG_SLOTS * 2))  # Tracks downloaded/converted at once
+TRANSCODE_QUEUE = int(os.environ.get('TRANSCODE_QUEUE', 64))  # Tracks waiting for a slot before new work is refused
+FFMPEG_NICE = int(os.environ.get('FFMPEG_NICE', 0))  # Niceness added to job FFmpeg processes, e.g. 10
+FFMPEG_PIN = os.environ.get('FFMPEG_PIN', '0') == '1'  # Pin each running FFmpeg pass to a core of its own
+UNKNOWN_DURATION = 600  # Seconds assumed when scheduling a track of unknown length
+SJF_AGING = int(os.environ.get('SJF_AGING', 10))  # Seconds of audio cost a waiting job makes up per second waited
+POPULARITY_HALF_LIFE = int(os.environ.get('POPULARITY_HALF_LIFE', 6 * 3600))  # Seconds for a hit count to halve
+PREFETCH_TOP_N = int(os.environ.get('PREFETCH_TOP_N', 20))  # Hottest tracks kept transcoded, 0 disables prefetching
+PREFETCH_INTERVAL = int(os.environ.get('PREFETCH_INTERVAL', 60))  # Seconds between prefetch rounds
+PREFETCH_MAX_LOAD = float(os.environ.get('PREFETCH_MAX_LOAD', 0.5))  # Prefetch only below this load average per core
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # X-Admin-Token for the /admin endpoints, which are off without it
+RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))  # Sustained requests per client IP, 0 disables
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 10))  # Requests a client IP may make back to back
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))  # Trusted reverse proxies setting X-Forwarded-For
+# Addresses of gateways trusted to set X-Client-Id for the callers behind them; from anyone else it is ignored
+CLIENT_ID_PROXIES = set(filter(None, (a.strip() for a in os.environ.get('CLIENT_ID_PROXIES', '').split(','))))
+SPAN_LOG = os.environ.get('SPAN_LOG', '0') == '1'  # Print every timed span as a JSON line
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # Seconds, for phase histograms
+AUDIO_CODEC = 'mp3'
+AUDIO_BITRATE = '128'  # Lowered from 192 for faster conversion
+# Output codecs: FFmpeg encoder, container extension and the bitrates (kbps) a request may ask for
+OUTPUT_CODECS = {
+    'mp3': {'encoder': 'libmp3lame', 'ext': 'mp3', 'bitrates': ('128', '192', '256', '320'), 'default': AUDIO_BITRATE},
+    'opus': {'encoder': 'libopus', 'ext': 'opus', 'bitrates': ('64', '96', '128', '160'), 'default': '96'},
+    'aac': {'encoder': 'aac', 'ext': 'm4a', 'bitrates': ('128', '192', '256'), 'default': '128'},
+}
+OUTPUT_FORMATS = tuple(OUTPUT_CODECS) + ('original',)  # 'original' keeps the source codec without re-encoding
+MAX_VARIANTS = int(os.environ.get('MAX_VARIANTS', 4))  # Extra variants one request may add to the same FFmpeg pass
+PREWARM_VARIANTS = os.environ.get('PREWARM_VARIANTS', '')  # e.g. "mp3:320,opus:96", added to every transcode pass
+DEFAULT_OPTIONS = {'format': AUDIO_CODEC, 'bitrate': AUDIO_BITRATE, 'tag': False, 'variants': []}  # Per request
+SOURCE_CODECS = {'mp3': 'mp3', 'opus': 'opus', 'aac': 'aac', 'm4a': 'aac', 'mp4a': 'aac'}
+
+# Job status itself lives in the state store, see StateStore
+status_lock = threading.Condition()  # Notified whenever a job changes in this process
+file_cleanup_interval = 600  # 10 minutes
+temp_file_ttl = 3600  # Temp files untouched for an hour belong to dead jobs
+job_ttl = 3600  # Forget finished jobs after 1 hour
+info_cache = {}  # normalized URL -> (expires_at, yt-dlp info dict); playlist:<URL> -> (expires_at, (title, entries))
+info_cache_lock = threading.Lock()
+client_queues = {}  # client id -> deque of (job_id, url, options) waiting for a slot
+client_running = {}  # client id -> number of that client's batch jobs on the pool
+client_reserved = {}  # client id -> queue room held by its batches still being created
+client_lock = threading.Lock()
+playlist_pending = {}  # playlist job id -> deque of (index, url) of tracks not yet on the pool
+playlist_lock = threading.Lock()
+
+if PROXY_COUNT:
+    # Rate limits are per client IP, which only the proxy knows
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT, x_proto=PROXY_COUNT)
+
+# Shared keep-alive session for cover art and other direct fetches
+http_session = requests.Session()
+http_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
+# Idle YoutubeDL instances for extraction, by kind, see borrow_extractor()
+extractor_pool = {}
+extractor_lock = threading.Lock()
+EXTRACTOR_OPTIONS = {
+    'track': {
+        'format': 'bestaudio',
+        'quiet': True,
+        'noplaylist': True
+    },
+    'playlist': {
+        'extract_flat': 'in_playlist',
+        'playlistend': PLAYLIST_MAX_TRACKS,
+        'quiet': True
+    }
+}
+
+# yt-dlp hands the heavy lifting to FFmpeg subprocesses, so threads are enough here
+job_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='download-worker')
+playlist_executor = ThreadPoolExecutor(max_workers=PLAYLIST_WORKERS, thread_name_prefix='playlist-worker')
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='io-worker')
+
+class StateStore:
+    """Key/value store for state that every worker must agree on.
+    
+    Keys are strings and values are JSON-compatible. Keys in use:
+    job:<id> and batch:<id> for status, active:<job key> for the job currently
+    doing some work, file:<name> for the cache index, cover:<url> for the
+    cover art index, lock:<name> for in-flight locks, pop:<job key> and
+    popfile:<name> for track popularity, and worker:<host:pid:nonce> for the
+    liveness of the processes that own jobs.
+    """
+    
+    shared = True  # Whether other processes see this store's writes
+    
+    @contextmanager
+    def lock(self, name, ttl=STATE_LOCK_TTL, poll=0.1):
+        """Mutex across every process using the store, released after ttl if its holder dies"""
+        key = f"lock:{name}"
+        token = uuid.uuid4().hex
+        while not self.add(key, token, ttl):
+            time.sleep(poll)
+        try:
+            yield
+        finally:
+            self.delete(key, token)
+
+class MemoryStore(StateStore):
+    """Process-local store; enough when a single worker serves everything"""
+    
+    shared = False
+    
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.data = {}  # key -> (expires_at or None, value)
+    
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= time.time():
+            del self.data[key]
+            return None
+        return entry[1]
+    
+    def get(self, key):
+        with self.mutex:
+            return copy.deepcopy(self._get(key))
+    
+    def set(self, key, value, ttl=None):
+        with self.mutex:
+            self.data[key] = (time.time() + ttl if ttl else None, copy.deepcopy(value))
+    
+    def add(self, key, value, ttl=None):
+        """Set a key only if it is absent, returning whether it was set"""
+        with self.mutex:
+            if self._get(key) is not None:
+                return False
+            self.data[key] = (time.time() + ttl if ttl else None, copy.deepcopy(value))
+            return True
+    
+    def delete(self, key, expected=None):
+        """Remove a key; with expected, only while it still holds that value"""
+        with self.mutex:
+            if expected is None or self._get(key) == expected:
+                self.data.pop(key, None)
+    
+    def update(self, key, fn):
+        """Atomically apply fn to a key's value in place and return fn's result (None if missing)"""
+        with self.mutex:
+            value = self._get(key)
+            return fn(value) if value is not None else None
+    
+    def scan(self, prefix):
+        """All live keys starting with prefix, as a dict"""
+        with self.mutex:
+            keys = [key for key in self.data if key.startswith(prefix)]
+            return {key: copy.deepcopy(value) for key in keys
+                    if (value := self._get(key)) is not None}
 
-# Store download status and cleanup old files
-download_status = {}
-file_cleanup_interval = 3600  # 1 hour
+class SQLiteStore(StateStore):
+    """Store in a SQLite file, shared by the worker processes of one host"""
+    
+    def __init__(self, path):
+        self.path = path
+        # Idle connections; threading.local would open one per greenlet under gevent
+        self.pool = []
+        self.pool_lock = threading.Lock()
+        with self.connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS state '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)')
+    
+    @contextmanager
+    def connection(self):
+        """Lend out an idle connection, used by one caller at a time"""
+        with self.pool_lock:
+            conn = self.pool.pop() if self.pool else None
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        try:
+            yield conn
+        finally:
+            with self.pool_lock:
+                self.pool.append(conn)
+    
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            # IMMEDIATE takes the write lock up front, so read-modify-write cannot interleave
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+    
+    def get(self, key):
+        with self.connection() as conn:
+            row = conn.execute('SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                               (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set(self, key, value, ttl=None):
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                         (key, json.dumps(value), time.time() + ttl if ttl else None))
+    
+    def add(self, key, value, ttl=None):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM state WHERE key = ? AND expires_at <= ?', (key, time.time()))
+            cursor = conn.execute('INSERT OR IGNORE INTO state VALUES (?, ?, ?)',
+                                  (key, json.dumps(value), time.time() + ttl if ttl else None))
+        return cursor.rowcount == 1
+    
+    def delete(self, key, expected=None):
+        with self.connection() as conn:
+            if expected is None:
+                conn.execute('DELETE FROM state WHERE key = ?', (key,))
+            else:
+                conn.execute('DELETE FROM state WHERE key = ? AND value = ?', (key, json.dumps(expected)))
+    
+    def update(self, key, fn):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                               (key, time.time())).fetchone()
+            if row is None:
+                return None
+            value = json.loads(row[0])
+            result = fn(value)
+            conn.execute('UPDATE state SET value = ? WHERE key = ?', (json.dumps(value), key))
+        return result
+    
+    def scan(self, prefix):
+        with self.connection() as conn:
+            rows = conn.execute('SELECT key, value FROM state WHERE substr(key, 1, ?) = ? '
+                                'AND (expires_at IS NULL OR expires_at > ?)',
+                                (len(prefix), prefix, time.time())).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+class RedisStore(StateStore):
+    """Store in Redis or any server speaking its protocol, shared across nodes"""
+    
+    def __init__(self, url=REDIS_URL, client=None, namespace='scdl:'):
+        import redis  # Optional dependency, only needed for this backend
+        self.redis = client or redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.watch_error = redis.WatchError
+    
+    def get(self, key):
+        raw = self.redis.get(self.namespace + key)
+        return json.loads(raw) if raw is not None else None
+    
+    def set(self, key, value, ttl=None):
+        self.redis.set(self.namespace + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+    
+    def add(self, key, value, ttl=None):
+        return bool(self.redis.set(self.namespace + key, json.dumps(value),
+                                   px=int(ttl * 1000) if ttl else None, nx=True))
+    
+    def delete(self, key, expected=None):
+        if expected is None:
+            self.redis.delete(self.namespace + key)
+            return
+        self.update(key, lambda value: None, remove=lambda value: value == expected)
+    
+    def update(self, key, fn, remove=None):
+        # Optimistic WATCH/MULTI rather than Lua, so plain protocol stand-ins work too;
+        # fn may run again after a conflicting write
+        key = self.namespace + key
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    if raw is None:
+                        pipe.unwatch()
+                        return None
+                    value = json.loads(raw)
+                    # Carry the expiry over by hand; SET ... KEEPTTL needs Redis 6
+                    ttl = pipe.pttl(key)
+                    result = fn(value)
+                    pipe.multi()
+                    if remove and remove(value):
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, json.dumps(value), px=ttl if ttl > 0 else None)
+                    pipe.execute()
+                    return result
+                except self.watch_error:
+                    continue
+    
+    def scan(self, prefix):
+        keys = list(self.redis.scan_iter(match=f"{self.namespace}{prefix}*", count=500))
+        if not keys:
+            return {}
+        values = self.redis.mget(keys)
+        start = len(self.namespace)
+        return {(key.decode() if isinstance(key, bytes) else key)[start:]: json.loads(raw)
+                for key, raw in zip(keys, values) if raw is not None}
+
+def make_state_store():
+    """Build the store selected by STATE_BACKEND"""
+    if STATE_BACKEND == 'sqlite':
+        return SQLiteStore(STATE_SQLITE_PATH)
+    if STATE_BACKEND == 'redis':
+        return RedisStore(REDIS_URL)
+    return MemoryStore()
+
+state = make_state_store()
+
+class TrackCache:
+    """Index of finished artifacts in DOWNLOAD_DIR.
+    
+    Files are named by content key (SoundCloud track id, codec, bitrate), so the
+    directory itself is the persistent index; mtime records the last access.
+    Files are also recorded in the state store, so a worker can serve what
+    another worker sharing the directory produced. Keeping the directory
+    within budget is the Janitor's job; every addition is appended to a
+    journal it follows.
+    """
+    
+    def __init__(self, directory, max_bytes, store, journal_path):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store = store
+        self.journal_path = journal_path
+        self.added = threading.Event()  # Set on every put(), wakes a janitor in this process
+        self.lock = threading.Lock()
+        self.entries = {}  # filename -> size
+        self.etags = {}  # filename -> (inode, size, content hash)
+        self.pins = {}  # filename -> readers in this process
+        self.load()
+    
+    def load(self):
+        """Rebuild the index from the files already on disk"""
+        entries = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                entries[entry.name] = entry.stat().st_size
+        with self.lock:
+            self.entries = entries
+    
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+    
+    def get(self, filename):
+        """Return the path of a cached file and mark it recently used, or None"""
+        file_path = self.path(filename)
+        if filename not in self.entries:
+            self.adopt(filename)
+        with self.lock:
+            if filename not in self.entries:
+                return None
+            if not os.path.exists(file_path):
+                # Evicted by the janitor, possibly in another process
+                del self.entries[filename]
+                self.etags.pop(filename, None)
+                return None
+        try:
+            os.utime(file_path)
+        except OSError:
+            pass
+        return file_path
+    
+    def adopt(self, filename):
+        """Index a file another process added to the shared directory"""
+        if not self.store.shared:
+            return
+        entry = self.store.get(f"file:{filename}")
+        if entry is None or not os.path.exists(self.path(filename)):
+            return
+        with self.lock:
+            self.entries.setdefault(filename, entry['size'])
+    
+    def put(self, filename, src_path):
+        """Move a finished file into the cache and tell the janitor about it"""
+        file_path = self.path(filename)
+        os.replace(src_path, file_path)
+        os.utime(file_path)  # Newest in the LRU, whatever mtime the source carried
+        size = os.path.getsize(file_path)
+        with self.lock:
+            self.entries[filename] = size
+            self.etags.pop(filename, None)
+        self.store.set(f"file:{filename}", {'size': size})
+        # One short O_APPEND write, so lines from concurrent workers never interleave
+        with open(self.journal_path, 'a') as journal:
+            journal.write(f"{filename}\t{size}\n")
+        self.added.set()
+        return file_path
+    
+    def etag(self, filename):
+        """Content hash of a cached file, computed once per file version"""
+        stat = os.stat(self.path(filename))
+        with self.lock:
+            known = self.etags.get(filename)
+        # put() swaps in a new inode, and mtime is our LRU clock, so it can't validate the hash
+        if known and known[:2] == (stat.st_ino, stat.st_size):
+            return known[2]
+        digest = hashlib.sha1()
+        with open(self.path(filename), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        etag = digest.hexdigest()
+        with self.lock:
+            self.etags[filename] = (stat.st_ino, stat.st_size, etag)
+        return etag
+    
+    @contextmanager
+    def pin(self, filename):
+        """Yield the path of a cached file (or None) that is not evicted until the block exits.
+        
+        Readers in this process are counted; other processes see the shared
+        flock held on the file.
+        """
+        file_path = self.get(filename)
+        try:
+            f = open(file_path, 'rb') if file_path else None
+        except FileNotFoundError:
+            f = None
+        if f is None:
+            yield None
+            return
+        with f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_SH)
+            with self.lock:
+                self.pins[filename] = self.pins.get(filename, 0) + 1
+            try:
+                yield file_path
+            finally:
+                with self.lock:
+                    self.pins[filename] -= 1
+                    if not self.pins[filename]:
+                        del self.pins[filename]
+    
+    def remove(self, filename):
+        """Delete a cached file unless it is pinned by a reader; returns whether it is gone"""
+        file_path = self.path(filename)
+        with self.lock:
+            if self.pins.get(filename):
+                return False
+            try:
+                with open(file_path, 'rb') as f:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except BlockingIOError:
+                return False
+            self.entries.pop(filename, None)
+            self.etags.pop(filename, None)
+        self.store.delete(f"file:{filename}")
+        if filename.startswith('cover-'):
+            # Cover URLs that led to this file, see fetch_cover()
+            for key, value in self.store.scan('cover:').items():
+                if value == filename:
+                    self.store.delete(key, expected=filename)
+        return True
 
-def cleanup_old_files():
-    """Remove files older than 1 hour"""
+track_cache = TrackCache(DOWNLOAD_DIR, CACHE_MAX_BYTES, state, os.path.join(STATE_DIR, 'added.log'))
+
+class Janitor:
+    """Keeps DOWNLOAD_DIR within its byte budget, least recently used files first.
+    
+    Every worker runs the thread, but only the one holding the flock on
+    lock_path does any work, so the directory is swept once per host. It
+    follows the journal of added files into a heap ordered by last access.
+    Reads bump a file's mtime rather than touching the heap, so an entry
+    is only found stale when it reaches the top, and is then pushed back
+    with the newer time. The full directory is scanned only on election
+    and every JANITOR_RESCAN seconds, in case a journal line went missing.
+    """
+    
+    def __init__(self, cache, lock_path):
+        self.cache = cache
+        self.lock_path = lock_path
+        self.lock_file = None
+        self.elected = False
+        self.heap = []  # (last access, filename); may hold stale and duplicate entries
+        self.sizes = {}  # filename -> size of every file in the directory
+        self.total_bytes = 0
+        self.offset = 0  # How far into the journal we have read
+    
+    def elect(self):
+        """Try to become the janitor; the lock is held until the process exits"""
+        if fcntl is None:
+            return True
+        if self.lock_file is None:
+            self.lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+    
+    def track(self, filename, size, last_access):
+        self.total_bytes += size - self.sizes.get(filename, 0)
+        self.sizes[filename] = size
+        heapq.heappush(self.heap, (last_access, filename))
+    
+    def rescan(self):
+        """Rebuild the index from the directory itself"""
+        # Files journaled before the truncation are already on disk for the scan to find
+        with open(self.cache.journal_path, 'a') as journal:
+            journal.truncate(0)
+        self.offset = 0
+        self.heap = []
+        self.sizes = {}
+        self.total_bytes = 0
+        for entry in os.scandir(self.cache.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                self.track(entry.name, stat.st_size, stat.st_mtime)
+    
+    def follow_journal(self):
+        """Index the files added since the last read of the journal"""
+        with open(self.cache.journal_path, 'rb') as journal:
+            journal.seek(self.offset)
+            data = journal.read()
+        # A line still being written is picked up next time
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        now = time.time()
+        for line in data.decode().splitlines():
+            filename, size = line.split('\t')
+            self.track(filename, int(size), now)
+    
+    def evict(self):
+        """Delete least recently used files until the directory fits the budget"""
+        pinned = []
+        # Never evict the most recent file, it was just produced for someone
+        while self.total_bytes > self.cache.max_bytes and len(self.sizes) > 1 and self.heap:
+            last_access, filename = heapq.heappop(self.heap)
+            if filename not in self.sizes:
+                continue  # Entry of a file already evicted
+            try:
+                mtime = os.stat(self.cache.path(filename)).st_mtime
+            except FileNotFoundError:
+                self.total_bytes -= self.sizes.pop(filename)
+                continue
+            if mtime > last_access:
+                heapq.heappush(self.heap, (mtime, filename))
+                continue
+            if not self.cache.remove(filename):
+                pinned.append((last_access, filename))
+                continue
+            self.total_bytes -= self.sizes.pop(filename)
+            print(f"Evicted cached file: {filename}")
+        for entry in pinned:
+            heapq.heappush(self.heap, entry)
+    
+    def remove_stale_temp_files(self):
+        cutoff = time.time() - temp_file_ttl
+        for entry in os.scandir(TEMP_DIR):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                print(f"Cleaned up stale temp file: {entry.name}")
+    
+    def run(self):
+        while not self.elect():
+            time.sleep(JANITOR_ELECTION_INTERVAL)
+        self.elected = True
+        print(f"Cache janitor elected in process {os.getpid()}")
+        next_rescan = next_temp_sweep = 0
+        while True:
+            try:
+                now = time.time()
+                if now >= next_rescan:
+                    self.rescan()
+                    next_rescan = now + JANITOR_RESCAN
+                if now >= next_temp_sweep:
+                    self.remove_stale_temp_files()
+                    next_temp_sweep = now + file_cleanup_interval
+                self.follow_journal()
+                self.evict()
+            except Exception as e:
+                print(f"Janitor error: {e}")
+            # Woken at once by additions in this process; other workers' show up in the journal
+            self.cache.added.wait(timeout=JANITOR_POLL_INTERVAL)
+            self.cache.added.clear()
+
+janitor = Janitor(track_cache, os.path.join(STATE_DIR, 'janitor.lock'))
+
+class SingleFlight:
+    """Coalesce concurrent calls sharing a key onto a single execution.
+    
+    The first caller runs the function; callers arriving while it runs block on
+    the same future and receive its result (or exception). Given a shared
+    store, the leader also waits out a leader in another process first, so
+    the function should start by checking for that leader's result.
+    """
+    
+    def __init__(self, store=None):
+        self.store = store
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Future
+    
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+        if not leader:
+            return future.result()
+        try:
+            with self.store.lock(f"flight:{key}") if self.store and self.store.shared else nullcontext():
+                result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+inflight = SingleFlight()
+file_flight = SingleFlight(state)  # For work whose result lands in the shared cache
+
+def turn(cost):
+    """Heap key of work waiting for a slot: cheapest first, with aging.
+    
+    Work that has waited cost / SJF_AGING seconds goes ahead of anything
+    arriving later, so a long track is delayed but never starved.
+    """
+    return time.time() + cost / SJF_AGING
+
+class Admission:
+    """Concurrency budget for download/transcode work with a bounded wait queue.
+    
+    Work runs through submit() or slot(), at most `slots` at a time, and
+    waiting work starts in order of its cost (see turn()). Submitted work
+    waits here rather than in an executor's FIFO queue, and is handed to the
+    executor once it has a slot and the executor a free thread (pools maps
+    each executor to its thread count). Request handlers reserve() room for
+    the work a request brings first, and refuse it with a Retry-After
+    instead of queueing it behind a backlog the server cannot catch up on.
+    Work held back elsewhere (a client's batch queue, a playlist's later
+    tracks) takes its room only when it is submitted; those queues are
+    bounded on their own, see CLIENT_QUEUE and PLAYLIST_CONCURRENCY.
+    """
+    
+    def __init__(self, slots, max_queue, pools):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.pools = pools
+        self.busy = dict.fromkeys(pools, 0)  # executor -> tasks handed to it and not yet done
+        self.cond = threading.Condition()
+        self.waiting = []  # heap of (turn, ticket, task), task None for a caller blocked in slot()
+        self.granted = set()  # Tickets of blocked callers whose turn has come
+        self.tickets = 0
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.avg_seconds = 10.0  # Moving average of how long work holds a slot
+    
+    def full(self):
+        """Whether new work must be refused; counts the refusal"""
+        with self.cond:
+            if self.queued < self.max_queue:
+                return False
+            self.rejected += 1
+            return True
+    
+    def reserve(self, n=1):
+        """Claim queue room for n pieces of work, later submitted with reserved=True; False (counted) if they don't fit"""
+        with self.cond:
+            if self.queued + n > self.max_queue:
+                self.rejected += 1
+                return False
+            self.queued += n
+            return True
+    
+    def unreserve(self, n=1):
+        """Give back room reserved for work that turned out not to be needed"""
+        with self.cond:
+            self.queued -= n
+    
+    def retry_after(self):
+        """Seconds until the queue is likely to have room again"""
+        with self.cond:
+            backlog = max(1, self.queued - self.max_queue + 1)
+            return max(1, min(120, math.ceil(self.avg_seconds * backlog / self.slots)))
+    
+    def _enqueue(self, cost, task, reserved=False):
+        if not reserved:
+            self.queued += 1
+        self.tickets += 1
+        heapq.heappush(self.waiting, (turn(cost), self.tickets, task))
+        self._dispatch()
+        return self.tickets
+    
+    def _dispatch(self):
+        """Give free slots to waiting work, earliest turn first; called holding cond"""
+        deferred = []  # Tasks whose executor has no free thread
+        while self.running < self.slots and self.waiting:
+            entry = heapq.heappop(self.waiting)
+            _, ticket, task = entry
+            if task is not None and self.busy[task[0]] >= self.pools[task[0]]:
+                deferred.append(entry)
+                continue
+            self.queued -= 1
+            self.running += 1
+            if task is None:
+                self.granted.add(ticket)
+                self.cond.notify_all()
+            else:
+                self.busy[task[0]] += 1
+                task[0].submit(self._run, *task)
+        for entry in deferred:
+            heapq.heappush(self.waiting, entry)
+    
+    def _release(self, started, executor=None):
+        with self.cond:
+            if executor is not None:
+                self.busy[executor] -= 1
+            self.running -= 1
+            self.completed += 1
+            self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * (time.time() - started)
+            self._dispatch()
+    
+    @contextmanager
+    def slot(self, cost=0):
+        """Block until it is this work's turn for a slot, and hold it for the duration of the block"""
+        with self.cond:
+            ticket = self._enqueue(cost, None)
+            while ticket not in self.granted:
+                self.cond.wait()
+            self.granted.discard(ticket)
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._release(started)
+    
+    def submit(self, executor, fn, *args, cost=0, reserved=False, **kwargs):
+        """Run fn on an executor once it gets a slot; it counts as queued from now on, or since reserve()"""
+        future = Future()
+        with self.cond:
+            self._enqueue(cost, (executor, fn, args, kwargs, future), reserved)
+        return future
+    
+    def _run(self, executor, fn, args, kwargs, future):
+        started = time.time()
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            self._release(started, executor)
+    
+    def stats(self):
+        with self.cond:
+            return {'slots': self.slots, 'running': self.running, 'queued': self.queued,
+                    'max_queue': self.max_queue, 'completed': self.completed, 'rejected': self.rejected}
+
+transcodes = Admission(TRANSCODE_SLOTS, TRANSCODE_QUEUE,
+                       {job_executor: MAX_WORKERS, playlist_executor: PLAYLIST_WORKERS})
+
+class TranscodeScheduler:
+    """Run FFmpeg passes at most `slots` at a time, shortest job first.
+    
+    Waiting passes start in order of their cost, the seconds of audio they
+    encode (see turn()), so one long mix doesn't hold up a queue of short
+    tracks. Given cores, each running pass is pinned to one of them;
+    niceness keeps FFmpeg from starving request handling of CPU.
+    """
+    
+    def __init__(self, slots, nice=0, cores=None):
+        self.slots = slots
+        self.nice = nice
+        self.free_cores = list(cores) if cores else None
+        self.cond = threading.Condition()
+        self.waiting = []  # heap of (turn, ticket)
+        self.tickets = 0
+        self.running = 0
+        self.completed = 0
+    
+    @contextmanager
+    def slot(self, cost=0):
+        """Wait for this pass's turn and hold a slot; yields a function to call with the started FFmpeg process"""
+        with self.cond:
+            self.tickets += 1
+            entry = (turn(cost), self.tickets)
+            heapq.heappush(self.waiting, entry)
+            while self.running >= self.slots or self.waiting[0] != entry:
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.running += 1
+            core = self.free_cores.pop() if self.free_cores else None
+            # The next cheapest pass may fit in a slot that is still free
+            self.cond.notify_all()
+        try:
+            yield lambda proc: self.place(proc, core)
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.completed += 1
+                if core is not None:
+                    self.free_cores.append(core)
+                self.cond.notify_all()
+    
+    def place(self, proc, core):
+        """Apply niceness and the core to a started FFmpeg process.
+        
+        Done from the parent, since preexec_fn is unsafe in a threaded
+        process. Both are per thread on Linux: the main thread is set first,
+        so threads it starts later inherit them, then any it already started.
+        """
+        if not self.nice and core is None:
+            return
+        priority = os.getpriority(os.PRIO_PROCESS, 0) + self.nice
+        
+        def apply(tid):
+            try:
+                if self.nice:
+                    os.setpriority(os.PRIO_PROCESS, tid, priority)
+                if core is not None:
+                    os.sched_setaffinity(tid, {core})
+            except OSError:
+                pass  # Already exited
+        
+        apply(proc.pid)
+        try:
+            tids = [int(tid) for tid in os.listdir(f"/proc/{proc.pid}/task")]
+        except OSError:
+            tids = []
+        for tid in tids:
+            if tid != proc.pid:
+                apply(tid)
+    
+    def stats(self):
+        with self.cond:
+            return {'slots': self.slots, 'running': self.running, 'waiting': len(self.waiting),
+                    'completed': self.completed}
+
+ffmpeg_scheduler = TranscodeScheduler(FFMPEG_SLOTS, FFMPEG_NICE,
+                                      sorted(os.sched_getaffinity(0)) if FFMPEG_PIN else None)
+
+class RateLimiter:
+    """Token bucket per client: `rate` requests per second sustained, `burst` back to back"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}  # client -> (tokens, refilled_at)
+        self.allowed = 0
+        self.limited = 0
+    
+    def take(self, client):
+        """Spend one of the client's tokens; returns 0, or seconds until a token is available"""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, refilled_at = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - refilled_at) * self.rate)
+            if tokens >= 1:
+                self.buckets[client] = (tokens - 1, now)
+                self.allowed += 1
+                return 0
+            self.buckets[client] = (tokens, now)
+            self.limited += 1
+            return math.ceil((1 - tokens) / self.rate)
+    
+    def prune(self):
+        """Forget clients whose bucket has refilled, which is where a new client starts anyway"""
+        now = time.monotonic()
+        with self.lock:
+            for client in [c for c, (tokens, refilled_at) in self.buckets.items()
+                           if tokens + (now - refilled_at) * self.rate >= self.burst]:
+                del self.buckets[client]
+    
+    def stats(self):
+        with self.lock:
+            return {'per_minute': round(self.rate * 60), 'burst': self.burst, 'clients': len(self.buckets),
+                    'allowed': self.allowed, 'limited': self.limited}
+
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_BURST)
+
+class UpstreamUnavailable(RuntimeError):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing.
+    
+    After `threshold` consecutive transient failures the circuit opens and
+    calls fail at once with UpstreamUnavailable for `cooldown` seconds, so
+    an outage costs no worker a timeout. Then a trial call goes through:
+    success closes the circuit, failure opens it again. A trial can be a
+    whole track download, so it only holds back other calls for
+    `trial_timeout` seconds; after that the next call is a trial too.
+    """
+    
+    def __init__(self, name, threshold, cooldown, trial_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.trial_timeout = trial_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_until = 0  # While a half-open circuit's trial call holds back other calls
+        self.trips = 0
+        self.rejected = 0
+    
+    def _blocked(self):
+        return self.opened_at is not None and time.time() < max(self.opened_at + self.cooldown, self.trial_until)
+    
+    def is_open(self):
+        with self.lock:
+            return self._blocked()
+    
+    def retry_after(self):
+        """Seconds until a call may be let through again"""
+        with self.lock:
+            if not self._blocked():
+                return 0
+            return max(1, math.ceil(max(self.opened_at + self.cooldown, self.trial_until) - time.time()))
+    
+    def before(self):
+        """Admit a call or raise UpstreamUnavailable"""
+        with self.lock:
+            if self._blocked():
+                self.rejected += 1
+                raise UpstreamUnavailable(f"{self.name} is unavailable, please retry shortly")
+            if self.opened_at is not None:
+                self.trial_until = time.time() + self.trial_timeout
+    
+    def record(self, ok):
+        """Report the outcome of an admitted call"""
+        with self.lock:
+            self.trial_until = 0
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.opened_at = time.time()
+    
+    def stats(self):
+        with self.lock:
+            return {'open': self._blocked(), 'failures': self.failures, 'trips': self.trips,
+                    'rejected': self.rejected}
+
+upstream = CircuitBreaker('SoundCloud', BREAKER_THRESHOLD, BREAKER_COOLDOWN, BREAKER_TRIAL)
+
+def is_transient(error):
+    """Whether an error, or one it wraps, is worth retrying: dropped connections, timeouts, 429 and 5xx"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError)):
+            return True
+        response = getattr(error, 'response', None)
+        status = getattr(error, 'status', None) or getattr(error, 'code', None)
+        status = status or getattr(response, 'status_code', None)
+        if isinstance(status, int) and (status == 429 or status >= 500):
+            return True
+        # yt-dlp's own network errors; it is already imported if it raised one
+        if any(cls.__name__ in ('TransportError', 'IncompleteRead', 'ContentTooShortError')
+               for cls in type(error).__mro__):
+            return True
+        # yt-dlp wraps the underlying error in DownloadError/ExtractorError
+        exc_info = getattr(error, 'exc_info', None)
+        error = (getattr(error, 'cause', None) or (exc_info[1] if exc_info else None)
+                 or error.__cause__ or error.__context__)
+    return False
+
+def call_upstream(fn, *args, retries=UPSTREAM_RETRIES, **kwargs):
+    """Call fn against SoundCloud through the circuit breaker, retrying transient errors.
+    
+    Backoff is exponential with full jitter, so callers that failed together
+    don't all retry together. Other errors (a private or deleted track) prove
+    the upstream is up and are raised at once.
+    """
+    for attempt in range(retries + 1):
+        upstream.before()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            transient = is_transient(e)
+            upstream.record(not transient)
+            if not transient or attempt == retries:
+                raise
+            upstream_retries.inc()
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+        else:
+            upstream.record(True)
+            return result
+
+metrics_registry = []  # Everything /metrics renders, in order
+
+def render_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+class Counter:
+    """Monotonic counter with optional labels, in Prometheus text format"""
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> count
+        metrics_registry.append(self)
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(tuple(labels[n] for n in self.labelnames), 0)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{render_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    """Distribution of observed values over fixed buckets, with optional labels"""
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [count per bucket (+Inf last), sum]
+        metrics_registry.append(self)
+    
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{render_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{render_labels(self.labelnames, key)} {total:.6f}")
+                lines.append(f"{self.name}_count{render_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class Sampled:
+    """Metric read from live state when /metrics is scraped; fn returns a number or None to skip"""
+    
+    def __init__(self, name, help_text, fn, kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.kind = kind
+        metrics_registry.append(self)
+    
+    def render(self):
+        value = self.fn()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+phase_seconds = Histogram('scdl_phase_seconds', 'Time spent per phase of serving a track', ('phase',))
+cache_lookups = Counter('scdl_cache_lookups_total', 'Cache lookups by kind and result', ('kind', 'result'))
+tracks_total = Counter('scdl_tracks_total', 'Tracks processed by outcome', ('result',))
+pipelines_total = Counter('scdl_pipeline_total', 'Files produced by each pipeline', ('pipeline',))
+served_bytes = Counter('scdl_served_bytes_total', 'Response body bytes sent by route', ('route',))
+upstream_retries = Counter('scdl_upstream_retries_total', 'Upstream calls retried after a transient error')
+Sampled('scdl_transcode_queue_depth', 'Tracks waiting for a transcode slot', lambda: transcodes.stats()['queued'])
+Sampled('scdl_transcodes_running', 'Tracks holding a transcode slot', lambda: transcodes.stats()['running'])
+Sampled('scdl_ffmpeg_waiting', 'FFmpeg passes waiting for their turn', lambda: ffmpeg_scheduler.stats()['waiting'])
+Sampled('scdl_ffmpeg_running', 'FFmpeg passes running for jobs', lambda: ffmpeg_scheduler.stats()['running'])
+Sampled('scdl_admission_rejected_total', 'Requests refused with 503 because the queue was full',
+        lambda: transcodes.stats()['rejected'], kind='counter')
+Sampled('scdl_upstream_circuit_open', 'Whether calls to SoundCloud are being refused', lambda: int(upstream.is_open()))
+Sampled('scdl_rate_limited_total', 'Requests refused with 429 by the per-IP rate limit',
+        lambda: rate_limiter.stats()['limited'], kind='counter')
+Sampled('scdl_active_jobs', 'Jobs queued or running', lambda: len(state.scan('active:')))
+# Only the elected janitor tracks the directory size
+Sampled('scdl_download_dir_bytes', 'Bytes of cached files in DOWNLOAD_DIR',
+        lambda: janitor.total_bytes if janitor.elected else None)
+Sampled('scdl_download_dir_free_bytes', 'Free space on the DOWNLOAD_DIR filesystem',
+        lambda: shutil.disk_usage(DOWNLOAD_DIR).free)
+
+@contextmanager
+def span(phase, **attrs):
+    """Time a phase of work into scdl_phase_seconds; with SPAN_LOG also print it as a JSON line"""
+    started = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        phase_seconds.observe(elapsed, phase=phase)
+        if SPAN_LOG:
+            print(json.dumps({'span': phase, 'seconds': round(elapsed, 4), 'error': error,
+                              'thread': threading.current_thread().name, **attrs}, default=str))
+
+def count_served(chunks, route):
+    """Pass a streamed response body through, counting its bytes"""
+    for chunk in chunks:
+        served_bytes.inc(len(chunk), route=route)
+        yield chunk
+
+def normalize_url(url):
+    """Canonical form of a SoundCloud URL for deduplication"""
+    parts = urlsplit(url if '://' in url else f'https://{url}')
+    host = parts.netloc.lower()
+    if host.startswith(('m.', 'www.')):
+        host = host.split('.', 1)[1]
+    return urlunsplit(('https', host, parts.path.rstrip('/'), '', ''))
+
+def cleanup_old_records():
+    """Forget expired jobs and metadata; files are left to the janitor"""
     while True:
+        # Nothing has expired yet at startup
+        time.sleep(file_cleanup_interval)
         try:
-            current_time = datetime.now()
-            for filename in os.listdir(DOWNLOAD_DIR):
-                file_path = os.path.join(DOWNLOAD_DIR, filename)
-                if os.path.isfile(file_path):
-                    file_time = datetime.fromtimestamp(os.path.getctime(file_path))
-                    if current_time - file_time > timedelta(hours=1):
-                        os.remove(file_path)
-                        print(f"Cleaned up old file: {filename}")
+            # A shared store only needs one process to prune it
+            if not state.shared or janitor.elected:
+                prune_jobs()
+                popularity.prune()
+            prune_info_cache()
+            rate_limiter.prune()
         except Exception as e:
             print(f"Cleanup error: {e}")
+
+def parse_variant(data):
+    """Validate a format and bitrate, returning ({'format', 'bitrate'}, error)"""
+    output_format = data.get('format') or AUDIO_CODEC
+    if output_format not in OUTPUT_FORMATS:
+        return None, f"Format must be one of: {', '.join(OUTPUT_FORMATS)}"
+    if output_format == 'original':
+        return {'format': output_format, 'bitrate': None}, None
+    codec = OUTPUT_CODECS[output_format]
+    bitrate = data.get('bitrate')
+    # Accept 320, "320" and "320k" alike
+    bitrate = str(bitrate).lower().removesuffix('k') if bitrate else codec['default']
+    if bitrate not in codec['bitrates']:
+        return None, f"Bitrate for {output_format} must be one of: {', '.join(codec['bitrates'])}"
+    return {'format': output_format, 'bitrate': bitrate}, None
+
+def parse_output_options(data):
+    """Validate the output options of a request body, returning (options, error).
+    
+    Besides the main format and bitrate a request may list extra 'variants',
+    which are encoded from the same decode of the source.
+    """
+    primary, error = parse_variant(data)
+    if error:
+        return None, error
+    extra = data.get('variants') or []
+    if not isinstance(extra, list) or len(extra) > MAX_VARIANTS:
+        return None, f"Variants must be a list of at most {MAX_VARIANTS} format/bitrate objects"
+    variants = []
+    for item in extra:
+        variant, error = parse_variant(item) if isinstance(item, dict) else (None, 'Each variant must be an object')
+        if error:
+            return None, error
+        if variant != primary and variant not in variants:
+            variants.append(variant)
+    options = dict(DEFAULT_OPTIONS, **primary)
+    options['tag'] = bool(data.get('tag', False))
+    options['variants'] = variants
+    return options, None
+
+def parse_variant_spec(spec):
+    """Variants listed as "format:bitrate,..." in configuration"""
+    variants = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        output_format, _, bitrate = item.partition(':')
+        variant, error = parse_variant({'format': output_format, 'bitrate': bitrate})
+        if error:
+            raise ValueError(f"Bad variant {item!r}: {error}")
+        variants.append(variant)
+    return variants
+
+prewarm_variants = parse_variant_spec(PREWARM_VARIANTS)
+
+def job_key(url, options):
+    """Identity of a job's work, shared by requests that can reuse it"""
+    return f"{normalize_url(url)}|{json.dumps(options, sort_keys=True)}"
+
+worker_ids = {}  # pid -> worker id, so a process forked after import gets its own
+
+def worker_id():
+    """Identity of this worker process in the state store, unique even when a pid is reused"""
+    pid = os.getpid()
+    if pid not in worker_ids:
+        worker_ids[pid] = f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:6]}"
+    return worker_ids[pid]
+
+def heartbeat():
+    """Mark this worker alive; its jobs are failed as orphans once the mark expires"""
+    state.set(f"worker:{worker_id()}", {'pid': os.getpid(), 'at': time.time()}, ttl=WORKER_TIMEOUT)
+
+def run_heartbeat():
+    while True:
+        time.sleep(WORKER_HEARTBEAT)
+        try:
+            heartbeat()
+        except Exception as e:
+            print(f"Heartbeat error: {e}")
+
+def orphaned(job):
+    """Whether an unfinished job belongs to a worker that stopped heartbeating"""
+    if not state.shared or job['status'] in ('finished', 'error'):
+        return False
+    owner = job.get('owner')
+    return owner != worker_id() and state.get(f"worker:{owner}") is None
+
+def fail_orphan(job):
+    """Fail a job whose worker died and release its claim, unless it finished meanwhile"""
+    def apply(entry):
+        if entry['status'] in ('finished', 'error'):
+            return False
+        entry.update(status='error', error='The worker running this job stopped', updated_at=time.time())
+        return True
+    if state.update(f"job:{job['job_id']}", apply):
+        print(f"Failed orphaned job {job['job_id']} of {job.get('owner')}")
+        state.delete(f"active:{job_key(job['url'], job['options'])}", job['job_id'])
+        notify_job_change()
+
+def create_job(url, options=None, **fields):
+    """Register a queued download job and return (job_id, created).
+    
+    A job already queued or running for the same normalized URL and output
+    options is reused, in which case created is False and nothing new should
+    be scheduled. Extra fields are stored on the new job. A job whose worker
+    died is failed instead of reused.
+    """
+    options = options or DEFAULT_OPTIONS
+    active_key = f"active:{job_key(url, options)}"
+    now = time.time()
+    job_id = str(uuid.uuid4())[:8]
+    # Write the job before claiming the key, so a claimed key never points at nothing
+    state.set(f"job:{job_id}", {
+        'job_id': job_id,
+        'url': url,
+        'options': options,
+        'status': 'queued',
+        'progress': 0,
+        'created_at': now,
+        'updated_at': now,
+        'owner': worker_id(),
+        **fields
+    })
+    while not state.add(active_key, job_id):
+        existing = state.get(active_key)
+        job = state.get(f"job:{existing}") if existing is not None else None
+        if job is not None and not orphaned(job):
+            state.delete(f"job:{job_id}")
+            return existing, False
+        if job is not None:
+            fail_orphan(job)
+        # The job it pointed at was pruned or has just been failed
+        state.delete(active_key, existing)
+    return job_id, True
+
+def finish_job(job_id, **fields):
+    """Record a job's final state and stop routing new requests to it"""
+    update_job(job_id, **fields)
+    job = get_job(job_id)
+    if job is not None:
+        state.delete(f"active:{job_key(job['url'], job['options'])}", job_id)
+
+def update_job(job_id, **fields):
+    """Merge fields into a job's status entry"""
+    def apply(job):
+        job.update(fields)
+        job['updated_at'] = time.time()
+    state.update(f"job:{job_id}", apply)
+    notify_job_change()
+
+def update_track(job_id, index, **fields):
+    """Merge fields into one track of a playlist job"""
+    def apply(job):
+        job['tracks'][index].update(fields)
+        job['updated_at'] = time.time()
+    state.update(f"job:{job_id}", apply)
+    notify_job_change()
+
+def notify_job_change():
+    with status_lock:
+        status_lock.notify_all()
+
+def wait_for_job_change(timeout):
+    """Block (holding status_lock) until a job changes or timeout passes.
+    
+    Only changes made in this process wake us, so with a shared store the
+    wait is capped at STATE_POLL_INTERVAL and callers re-read the job.
+    """
+    status_lock.wait(timeout=min(timeout, STATE_POLL_INTERVAL) if state.shared else timeout)
+
+def get_job(job_id):
+    """Return a snapshot of a job's status, or None if unknown; a dead worker's job reads as failed"""
+    job = state.get(f"job:{job_id}")
+    if job is not None and orphaned(job):
+        fail_orphan(job)
+        job = state.get(f"job:{job_id}")
+    return job
+
+def prune_jobs():
+    """Fail orphaned jobs, then drop finished or failed jobs older than job_ttl and batches whose jobs are all gone"""
+    cutoff = time.time() - job_ttl
+    jobs = state.scan('job:')
+    for key, job in list(jobs.items()):
+        if orphaned(job):
+            fail_orphan(job)
+            continue
+        if job['status'] in ('finished', 'error') and job['updated_at'] < cutoff:
+            state.delete(key)
+            del jobs[key]
+    for key, batch in state.scan('batch:').items():
+        if not any(f"job:{item.get('job_id')}" in jobs for item in batch['items']):
+            state.delete(key)
+
+def make_progress_hook(job_id, index=None):
+    """Build a progress hook that reports into the job's status entry.
+    
+    It accepts yt-dlp progress dicts plus our own {'status': 'converting'}
+    updates from the FFmpeg stage. With an index the progress goes to that
+    track of a playlist job. Updates within a phase are throttled to one per
+    PROGRESS_INTERVAL so event stream subscribers are not flooded.
+    """
+    last = {'status': None, 'time': 0}
+    
+    def report(**fields):
+        if index is None:
+            update_job(job_id, **fields)
+        else:
+            update_track(job_id, index, **fields)
+    
+    def hook(d):
+        now = time.time()
+        if d['status'] == last['status'] and now - last['time'] < PROGRESS_INTERVAL:
+            return
+        last['status'] = d['status']
+        last['time'] = now
         
-        time.sleep(file_cleanup_interval)
+        if d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            downloaded = d.get('downloaded_bytes', 0)
+            report(status='downloading',
+                   progress=round(downloaded * 100 / total, 1) if total else 0,
+                   downloaded_bytes=downloaded,
+                   total_bytes=total,
+                   speed=d.get('speed'),
+                   eta=d.get('eta'))
+        elif d['status'] == 'finished':
+            report(status='converting', progress=100, speed=None, eta=None, transcode_progress=0)
+        elif d['status'] == 'converting':
+            report(status='converting', pipeline=d.get('pipeline'), transcode_progress=d.get('transcode_progress'))
+    return hook
+
+class Popularity:
+    """Exponentially decayed request counts per track and output options.
+    
+    Counts live in the state store so every worker adds to the same ones,
+    and halve every half_life seconds without hits. The file rendered for an
+    entry is indexed so that /download_file hits count towards it too.
+    Pinned entries are prefetched whatever their count.
+    """
+    
+    def __init__(self, store, half_life):
+        self.store = store
+        self.half_life = half_life
+    
+    def score(self, entry, now=None):
+        """An entry's count decayed to now"""
+        return entry['score'] * 0.5 ** (((now or time.time()) - entry['at']) / self.half_life)
+    
+    def hit(self, url, options, pinned=None):
+        """Count a request for a track; pinned, if given, also sets or clears the pin"""
+        key = f"pop:{job_key(url, options)}"
+        self.store.add(key, {'url': url, 'options': options, 'score': 0, 'at': time.time(),
+                             'file': None, 'pinned': False})
+        
+        def bump(entry):
+            now = time.time()
+            entry['score'] = self.score(entry, now) + (1 if pinned is None else 0)
+            entry['at'] = now
+            if pinned is not None:
+                entry['pinned'] = pinned
+            return entry
+        return self.store.update(key, bump)
+    
+    def hit_file(self, filename):
+        """Count a request for a rendered file towards the entry it was rendered for"""
+        key = self.store.get(f"popfile:{filename}")
+        if key:
+            self.store.update(key, lambda entry: entry.update(score=self.score(entry) + 1, at=time.time()))
+    
+    def rendered(self, url, options, filename):
+        """Record the file a popular track was rendered to"""
+        key = f"pop:{job_key(url, options)}"
+        if self.store.update(key, lambda entry: entry.update(file=filename) or True):
+            self.store.set(f"popfile:{filename}", key)
+    
+    def top(self, n):
+        """Pinned entries, then the n hottest others, as (key, entry, score) hottest first"""
+        now = time.time()
+        ranked = sorted(((key, entry, self.score(entry, now)) for key, entry in self.store.scan('pop:').items()),
+                        key=lambda item: (item[1]['pinned'], item[2]), reverse=True)
+        pinned = [item for item in ranked if item[1]['pinned']]
+        return pinned + [item for item in ranked if not item[1]['pinned']][:n]
+    
+    def prune(self):
+        """Forget unpinned entries that have decayed to almost nothing"""
+        now = time.time()
+        for key, entry in self.store.scan('pop:').items():
+            if not entry['pinned'] and self.score(entry, now) < 0.05:
+                self.store.delete(key)
+                if entry['file']:
+                    self.store.delete(f"popfile:{entry['file']}", key)
+
+popularity = Popularity(state, POPULARITY_HALF_LIFE)
+
+class Prefetcher:
+    """Keeps the hottest tracks rendered and at the recent end of the cache.
+    
+    Each round walks popularity.top() and re-renders whatever has been
+    evicted; touching resident files keeps the janitor from evicting them.
+    Rendering only happens while live work leaves the server idle, and the
+    wait between rounds doubles while it stays busy.
+    """
+    
+    def __init__(self, popularity, top_n, interval):
+        self.popularity = popularity
+        self.top_n = top_n
+        self.interval = interval
+        self.prefetched = 0
+    
+    def idle(self):
+        """Whether nothing live is waiting and CPU is to spare"""
+        admission = transcodes.stats()
+        ffmpeg = ffmpeg_scheduler.stats()
+        if admission['queued'] or ffmpeg['waiting'] or ffmpeg['running'] * 2 >= ffmpeg['slots']:
+            return False
+        if hasattr(os, 'getloadavg'):
+            return os.getloadavg()[0] < (os.cpu_count() or 1) * PREFETCH_MAX_LOAD
+        return True
+    
+    def round(self):
+        """Make every hot track resident, returning False if live work interrupted it"""
+        for key, entry, _ in self.popularity.top(self.top_n):
+            if entry['file'] and track_cache.get(entry['file']):
+                continue
+            if not self.idle():
+                return False
+            with transcodes.slot(), span('prefetch', url=entry['url']):
+                result = download_soundcloud_track(entry['url'], f"prefetch-{uuid.uuid4().hex[:8]}",
+                                                   options=entry['options'])
+            if result['success']:
+                self.popularity.rendered(entry['url'], entry['options'], result['file'])
+                if not result['cached']:
+                    self.prefetched += 1
+            else:
+                print(f"Prefetch of {entry['url']} failed: {result['error']}")
+        return True
+    
+    def run(self):
+        delay = self.interval
+        while True:
+            time.sleep(delay)
+            # Like pruning, one process is enough
+            if state.shared and not janitor.elected:
+                continue
+            try:
+                delay = self.interval if self.round() else min(delay * 2, self.interval * 16)
+            except Exception as e:
+                print(f"Prefetch error: {e}")
+
+prefetcher = Prefetcher(popularity, PREFETCH_TOP_N, PREFETCH_INTERVAL)
+
+background_started = threading.Event()
+background_lock = threading.Lock()
+
+def start_background_threads():
+    """Start the heartbeat, cleanup, janitor and prefetch threads once per process.
+    
+    Nothing starts at import, so importing the app (or forking from a preloaded
+    master) stays cheap; gunicorn.conf.py calls this when a worker is ready and
+    the first request does otherwise.
+    """
+    with background_lock:
+        if background_started.is_set():
+            return
+        if state.shared:
+            heartbeat()
+            threading.Thread(target=run_heartbeat, daemon=True).start()
+        threading.Thread(target=cleanup_old_records, daemon=True).start()
+        threading.Thread(target=janitor.run, daemon=True).start()
+        if PREFETCH_TOP_N:
+            threading.Thread(target=prefetcher.run, daemon=True).start()
+        background_started.set()
+
+@app.before_request
+def ensure_background_threads():
+    """Start the background threads on the first request when no server hook did"""
+    if not background_started.is_set():
+        start_background_threads()
+
+def run_download_job(job_id, url, options=None):
+    """Worker entry point: run a queued job and record its outcome"""
+    update_job(job_id, status='downloading')
+    try:
+        result = download_soundcloud_track(url, job_id, progress_hook=make_progress_hook(job_id), options=options)
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    
+    if result['success']:
+        finish_job(job_id,
+                   status='finished',
+                   progress=100,
+                   track_id=result['track_id'],
+                   title=result['title'],
+                   file=result['file'],
+                   variants=result['variants'],
+                   cover_file=result['cover_file'],
+                   cover_url=result['thumbnail_url'],
+                   cover_ext=result['cover_ext'],
+                   pipeline=result['pipeline'],
+                   tagged=result['tagged'],
+                   cached=result['cached'])
+        popularity.rendered(url, options or DEFAULT_OPTIONS, result['file'])
+    else:
+        finish_job(job_id, status='error', error=result['error'])
+
+def reserve_client_room(client, n):
+    """Claim room for n jobs in a client's batch queue; False if it would hold more than CLIENT_QUEUE"""
+    with client_lock:
+        held = len(client_queues.get(client, ())) + client_reserved.get(client, 0)
+        if held + n > CLIENT_QUEUE:
+            return False
+        client_reserved[client] = client_reserved.get(client, 0) + n
+        return True
+
+def release_client_room(client, n):
+    """Give back room claimed by reserve_client_room(), once the batch's jobs are queued"""
+    with client_lock:
+        client_reserved[client] -= n
+        if not client_reserved[client]:
+            del client_reserved[client]
+
+def submit_client_job(client, job_id, url, options=None):
+    """Queue a job for the shared pool, holding it back while the client is at its limit"""
+    with client_lock:
+        client_queues.setdefault(client, deque()).append((job_id, url, options))
+    pump_client_queue(client)
+
+def pump_client_queue(client):
+    """Move a client's waiting jobs onto the pool while it has free slots"""
+    with client_lock:
+        queue = client_queues.get(client)
+        ready = []
+        while queue and client_running.get(client, 0) < CLIENT_CONCURRENCY:
+            ready.append(queue.popleft())
+            client_running[client] = client_running.get(client, 0) + 1
+        if not queue:
+            client_queues.pop(client, None)
+    # Only now does the job take room in the shared queue
+    for job_id, url, options in ready:
+        transcodes.submit(job_executor, run_client_job, client, job_id, url, options, cost=job_cost(url, options))
+
+def run_client_job(client, job_id, url, options):
+    """Run a batch job, then hand the client's slot to its next waiting job"""
+    try:
+        run_download_job(job_id, url, options)
+    finally:
+        with client_lock:
+            client_running[client] -= 1
+            if not client_running[client]:
+                del client_running[client]
+        pump_client_queue(client)
+
+def batch_status(batch_id):
+    """Per-item job status of a batch plus aggregate counts, or None if unknown"""
+    batch = state.get(f"batch:{batch_id}")
+    if batch is None:
+        return None
+    items = []
+    for item in batch['items']:
+        job = get_job(item['job_id']) if 'job_id' in item else None
+        if job is not None:
+            for field in ('status', 'progress', 'title', 'file', 'pipeline', 'cached', 'error'):
+                if field in job:
+                    item[field] = job[field]
+        items.append(item)
+    
+    counts = {}
+    for item in items:
+        counts[item['status']] = counts.get(item['status'], 0) + 1
+    done = sum(counts.get(status, 0) for status in ('finished', 'error', 'invalid'))
+    return {
+        'batch_id': batch_id,
+        'status': 'finished' if done == len(items) else 'running',
+        'total': len(items),
+        'counts': counts,
+        'progress': round(sum(item.get('progress', 0) for item in items) / len(items), 1) if items else 100,
+        'items': items
+    }
+
+def cache_filename(track_id, codec=AUDIO_CODEC, bitrate=AUDIO_BITRATE, tagged=False):
+    """Cache key for a track rendered in a given codec/bitrate (None keeps the source's)"""
+    suffix = '-tagged' if tagged else ''
+    if bitrate is None:
+        return f"{track_id}-original{suffix}.{codec}"
+    return f"{track_id}-{bitrate}k{suffix}.{codec}"
+
+def new_extractor(kind='track'):
+    """A YoutubeDL for metadata extraction with only the SoundCloud extractors loaded"""
+    # Deferred: importing yt_dlp is a large part of a cold start
+    import yt_dlp
+    ydl = yt_dlp.YoutubeDL(EXTRACTOR_OPTIONS[kind], auto_init=False)
+    for extractor in soundcloud_extractors():
+        ydl.add_info_extractor(extractor)
+    return ydl
+
+@contextmanager
+def borrow_extractor(kind='track'):
+    """Lend out an idle YoutubeDL of this process for metadata extraction.
+    
+    Reusing instances preserves the initialized SoundCloud extractor (and the
+    client_id it scraped) plus yt-dlp's keep-alive connections, instead of
+    paying for them on every request. YoutubeDL is not thread-safe, so each
+    is lent to one caller at a time; a pool rather than threading.local, which
+    gevent makes per greenlet, i.e. per request.
+    """
+    with extractor_lock:
+        idle = extractor_pool.setdefault(kind, [])
+        ydl = idle.pop() if idle else None
+    if ydl is None:
+        ydl = new_extractor(kind)
+    try:
+        yield ydl
+    finally:
+        with extractor_lock:
+            idle.append(ydl)
+
+@functools.cache
+def soundcloud_extractors():
+    """yt-dlp's SoundCloud extractor classes in its own order, leaving the other extractors unloaded"""
+    from yt_dlp.extractor import soundcloud
+    return [cls for cls in vars(soundcloud).values()
+            if isinstance(cls, type) and cls.__module__ == soundcloud.__name__ and cls.__dict__.get('_VALID_URL')]
+
+def cover_url_for(info):
+    """URL of the COVER_SIZE artwork variant, falling back to yt-dlp's pick"""
+    for thumbnail in info.get('thumbnails') or []:
+        if thumbnail.get('id') == COVER_SIZE and thumbnail.get('url'):
+            return thumbnail['url']
+    thumbnail_url = info.get('thumbnail')
+    if thumbnail_url and 'sndcdn.com' in thumbnail_url:
+        # SoundCloud encodes the size in the file name, e.g. artworks-...-large.jpg
+        return re.sub(r'-(?:large|original|crop|small|badge|tiny|mini|t\d+x\d+)\.(jpg|png)$',
+                      f'-{COVER_SIZE}.\\1', thumbnail_url)
+    return thumbnail_url
+
+def fetch_cover(thumbnail_url, job_id):
+    """Fetch cover art into the cache and return (cover_file, cover_path).
+    
+    Covers are stored under a hash of their bytes, so tracks sharing the same
+    artwork (albums, artist avatars) share one file. A URL seen before is
+    answered from the cover index in the state store without touching the network.
+    Index entries go when their file is evicted, and expire after
+    COVER_INDEX_TTL in any case.
+    """
+    cover_file = state.get(f"cover:{thumbnail_url}")
+    if cover_file:
+        cover_path = track_cache.get(cover_file)
+        if cover_path:
+            cache_lookups.inc(kind='cover', result='hit')
+            return cover_file, cover_path
+    cache_lookups.inc(kind='cover', result='miss')
+    
+    with span('cover', url=thumbnail_url):
+        response = http_session.get(thumbnail_url, timeout=5)  # Lowered timeout from 30 to 5 seconds
+        response.raise_for_status()
+    
+    img_ext = thumbnail_url.split('.')[-1].split('?')[0].lower()
+    cover_ext = img_ext if img_ext in ['jpg', 'jpeg', 'png', 'webp'] else 'jpg'
+    cover_file = f"cover-{hashlib.sha1(response.content).hexdigest()[:20]}.{cover_ext}"
+    cover_path = track_cache.get(cover_file)
+    if cover_path is None:
+        temp_path = os.path.join(TEMP_DIR, f"{job_id}_{cover_file}")
+        with open(temp_path, 'wb') as f:
+            f.write(response.content)
+        cover_path = track_cache.put(cover_file, temp_path)
+    state.set(f"cover:{thumbnail_url}", cover_file, ttl=COVER_INDEX_TTL)
+    return cover_file, cover_path
+
+def extract_track_info(url):
+    """Resolve track metadata without downloading audio, cached for INFO_CACHE_TTL"""
+    key = normalize_url(url)
+    with info_cache_lock:
+        entry = info_cache.get(key)
+        if entry and entry[0] > time.time():
+            cache_lookups.inc(kind='info', result='hit')
+            return entry[1]
+    cache_lookups.inc(kind='info', result='miss')
+    
+    def resolve():
+        with span('extract', url=key):
+            with borrow_extractor('track') as ydl:
+                info = call_upstream(ydl.extract_info, url, download=False)
+        with info_cache_lock:
+            info_cache[key] = (time.time() + INFO_CACHE_TTL, info)
+        return info
+    
+    return inflight.do(f"info:{key}", resolve)
+
+def cached_info(url):
+    """Unexpired metadata from the lookup cache, or None; never asks SoundCloud"""
+    with info_cache_lock:
+        entry = info_cache.get(normalize_url(url))
+    return entry[1] if entry and entry[0] > time.time() else None
+
+def prune_info_cache():
+    """Drop expired metadata entries"""
+    now = time.time()
+    with info_cache_lock:
+        for key in [k for k, (expires_at, _) in info_cache.items() if expires_at <= now]:
+            del info_cache[key]
+
+def summarize_info(info):
+    """The subset of yt-dlp metadata the frontend needs"""
+    return {
+        'track_id': str(info['id']),
+        'title': info.get('title', 'Unknown Track'),
+        'uploader': info.get('uploader'),
+        'duration': info.get('duration'),
+        'thumbnail_url': info.get('thumbnail'),
+        'formats': [{
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'acodec': f.get('acodec'),
+            'abr': f.get('abr'),
+            'protocol': f.get('protocol')
+        } for f in info.get('formats') or []]
+    }
+
+def extract_playlist_entries(url):
+    """Enumerate a set or artist page without resolving each track, cached for INFO_CACHE_TTL"""
+    key = f"playlist:{normalize_url(url)}"
+    with info_cache_lock:
+        entry = info_cache.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+    
+    def enumerate_entries():
+        with borrow_extractor('playlist') as ydl:
+            info = call_upstream(ydl.extract_info, url, download=False)
+        if info.get('_type') != 'playlist':
+            raise ValueError('URL is not a SoundCloud set or artist page')
+        entries = [{'url': e.get('url') or e.get('webpage_url'), 'title': e.get('title')}
+                   for e in info.get('entries') or []]
+        result = (info.get('title') or 'SoundCloud Playlist', [e for e in entries if e['url']])
+        with info_cache_lock:
+            info_cache[key] = (time.time() + INFO_CACHE_TTL, result)
+        return result
+    
+    return inflight.do(key, enumerate_entries)
+
+def start_playlist_job(job_id, options=None):
+    """Feed a playlist job's tracks to the playlist pool, PLAYLIST_CONCURRENCY at a time"""
+    job = get_job(job_id)
+    update_job(job_id, status='downloading')
+    with playlist_lock:
+        playlist_pending[job_id] = deque((index, track['url']) for index, track in enumerate(job['tracks']))
+    for _ in range(PLAYLIST_CONCURRENCY):
+        submit_playlist_track(job_id, options)
+
+def submit_playlist_track(job_id, options=None):
+    """Move a playlist's next waiting track onto the pool, if it has one"""
+    with playlist_lock:
+        pending = playlist_pending.get(job_id)
+        if not pending:
+            playlist_pending.pop(job_id, None)
+            return
+        index, url = pending.popleft()
+    transcodes.submit(playlist_executor, run_playlist_track, job_id, index, url, options, cost=job_cost(url, options))
+
+def run_playlist_track(job_id, index, url, options=None):
+    """Download one playlist track, record it and hand its place to the playlist's next track"""
+    try:
+        result = download_soundcloud_track(url, f"{job_id}-{index}", progress_hook=make_progress_hook(job_id, index),
+                                           options=options)
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    try:
+        finish_playlist_track(job_id, index, result)
+    finally:
+        submit_playlist_track(job_id, options)
+
+def finish_playlist_track(job_id, index, result):
+    """Record one playlist track's outcome and close the job after the last one"""
+    if result['success']:
+        update_track(job_id, index, status='finished', progress=100, file=result['file'],
+                     variants=result['variants'], title=result['title'], pipeline=result['pipeline'],
+                     tagged=result['tagged'], cached=result['cached'])
+    else:
+        update_track(job_id, index, status='error', error=result['error'])
+    
+    def tally(job):
+        done = [t for t in job['tracks'] if t['status'] in ('finished', 'error')]
+        failed = sum(1 for t in done if t['status'] == 'error')
+        job['progress'] = round(len(done) * 100 / len(job['tracks']), 1)
+        job['completed'] = len(done) - failed
+        job['failed'] = failed
+        return len(done), failed, len(done) == len(job['tracks'])
+    done, failed, all_done = state.update(f"job:{job_id}", tally)
+    if all_done:
+        if failed == done:
+            finish_job(job_id, status='error', error='No track in the playlist could be downloaded')
+        else:
+            finish_job(job_id, status='finished')
+
+class ZipOutput:
+    """Write-only sink for ZipFile whose bytes are drained into an HTTP response"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def zip_entry_name(index, track):
+    """Unique, filesystem-safe archive name for a playlist track"""
+    ext = track['file'].rsplit('.', 1)[-1]
+    title = re.sub(r'[\\/:*?"<>|]+', '_', track.get('title') or 'Unknown Track').strip()
+    return f"{index + 1:02d} - {title}.{ext}"
+
+def stream_playlist_zip(job_id):
+    """Yield a ZIP of a playlist job, adding each track as soon as it finishes"""
+    out = ZipOutput()
+    written = set()
+    # Stored, not deflated: audio does not compress and this keeps CPU free
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as zf:
+        while True:
+            with status_lock:
+                job = get_job(job_id)
+                if job is None:
+                    break
+                ready = [(i, t) for i, t in enumerate(job['tracks'])
+                         if t['status'] == 'finished' and i not in written]
+                if not ready:
+                    if all(t['status'] in ('finished', 'error') for t in job['tracks']):
+                        break
+                    wait_for_job_change(5)
+                    continue
+            for index, track in ready:
+                written.add(index)
+                with track_cache.pin(track['file']) as file_path:
+                    if not file_path:
+                        continue
+                    zinfo = zipfile.ZipInfo.from_file(file_path, zip_entry_name(index, track))
+                    with open(file_path, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                        while True:
+                            chunk = src.read(STREAM_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                            yield out.drain()
+                yield out.drain()
+    yield out.drain()
+
+def selected_format(info):
+    """The format yt-dlp picked for 'bestaudio' during extraction"""
+    for f in info.get('formats') or []:
+        if f.get('format_id') == info.get('format_id'):
+            return f
+    return info
+
+def source_codec(fmt):
+    """Audio codec of a yt-dlp format, normalized to mp3/aac/opus where known"""
+    acodec = fmt.get('acodec')
+    if acodec and acodec != 'none':
+        return SOURCE_CODECS.get(acodec.split('.')[0], acodec)
+    return SOURCE_CODECS.get(fmt.get('ext'))
+
+def copies_source(fmt, codec, bitrate):
+    """Whether a source format already is codec at bitrate, so its stream can be copied"""
+    if source_codec(fmt) != codec:
+        return False
+    if fmt.get('abr'):
+        return str(round(fmt['abr'])) == bitrate
+    # SoundCloud's progressive MP3 is 128k even when the bitrate isn't reported
+    return codec == 'mp3' and bitrate == AUDIO_BITRATE
+
+def pick_source_format(info, output_format=AUDIO_CODEC, bitrate=AUDIO_BITRATE):
+    """Choose the source stream that needs the least work for the requested output.
+    
+    A source already in the requested codec and bitrate wins outright since it
+    can be copied, then progressive HTTP beats HLS, then higher bitrate wins.
+    For original output the best bitrate in a codec we can keep untouched wins.
+    """
+    formats = [f for f in info.get('formats') or []
+               if f.get('url') and (f.get('preference') or 0) > -10]  # -10 marks 30s previews
+    if not formats:
+        return selected_format(info)
+    
+    def rank(f):
+        if output_format == 'original':
+            return (source_codec(f) in OUTPUT_CODECS, f.get('abr') or 0, f.get('protocol') == 'http')
+        return (copies_source(f, output_format, bitrate), f.get('protocol') == 'http', f.get('abr') or 0)
+    return max(formats, key=rank)
+
+def plan_pipeline(fmt, output_format=AUDIO_CODEC, bitrate=AUDIO_BITRATE):
+    """Decide how to turn a source format into the output: returns (pipeline, codec).
+    
+    'passthrough' keeps the downloaded file as is, 'remux' copies the audio
+    stream into a new container, 'transcode' re-encodes to the output codec.
+    """
+    codec = source_codec(fmt)
+    if output_format == 'original':
+        if codec not in OUTPUT_CODECS:
+            return 'transcode', AUDIO_CODEC
+    elif not copies_source(fmt, output_format, bitrate):
+        return 'transcode', output_format
+    # HLS downloads are MPEG-TS segments whatever their extension says
+    if fmt.get('ext') == OUTPUT_CODECS[codec]['ext'] and fmt.get('protocol') == 'http':
+        return 'passthrough', codec
+    return 'remux', codec
+
+def pass_cost(info, pipelines):
+    """Scheduling cost of an FFmpeg pass: the seconds of audio it encodes, stream copies are nearly free"""
+    return (info.get('duration') or UNKNOWN_DURATION) * sum(pipeline == 'transcode' for pipeline in pipelines)
+
+def job_cost(url, options=None):
+    """Cost of a queued job from its cached metadata, without asking SoundCloud; unknown tracks count as long"""
+    options = options or DEFAULT_OPTIONS
+    info = cached_info(url)
+    if info is None:
+        return UNKNOWN_DURATION
+    fmt = pick_source_format(info, options['format'], options['bitrate'])
+    return pass_cost(info, [plan_pipeline(fmt, variant['format'], variant['bitrate'])[0]
+                            for variant in [options] + options['variants']])
+
+def plan_output(fmt, track_id, variant, tag=False):
+    """Pipeline, codec and cache file for rendering one requested variant from a source format"""
+    pipeline, codec = plan_pipeline(fmt, variant['format'], variant['bitrate'])
+    ext = OUTPUT_CODECS[codec]['ext']
+    # ID3 tags only apply to MP3; writing them needs an FFmpeg pass, but a copy is enough
+    tagged = tag and ext == 'mp3'
+    if tagged and pipeline == 'passthrough':
+        pipeline = 'remux'
+    return {
+        'format': variant['format'],
+        'bitrate': variant['bitrate'],
+        'pipeline': pipeline,
+        'codec': codec,
+        'ext': ext,
+        'tagged': tagged,
+        'file': cache_filename(track_id, ext, variant['bitrate'], tagged)
+    }
+
+def served_from_cache(url, options=None):
+    """Whether a track's metadata and every requested file are cached, so serving it needs no SoundCloud"""
+    options = options or DEFAULT_OPTIONS
+    info = cached_info(url)
+    if info is None:
+        return False
+    fmt = pick_source_format(info, options['format'], options['bitrate'])
+    return all(track_cache.get(plan_output(fmt, str(info['id']), variant, options['tag'])['file'])
+               for variant in [options] + options['variants'])
+
+def output_args(plan, tags=None, cover=False):
+    """FFmpeg options for one planned output of a convert_audio pass"""
+    args = ['-map', '0:a']
+    if plan['tagged'] and cover:
+        args += ['-map', '1:0', '-c:v', 'copy', '-disposition:v', 'attached_pic',
+                 '-metadata:s:v', 'title=Album cover', '-metadata:s:v', 'comment=Cover (front)']
+    if plan['pipeline'] == 'remux':
+        args += ['-c:a', 'copy']
+    else:
+        # Original output from a codec we can't keep falls back to the default bitrate
+        bitrate = plan['bitrate'] or OUTPUT_CODECS[plan['codec']]['default']
+        args += ['-c:a', OUTPUT_CODECS[plan['codec']]['encoder'], '-b:a', f'{bitrate}k']
+    if plan['tagged'] and tags:
+        args += ['-id3v2_version', '3']
+        for key, value in tags.items():
+            if value:
+                args += ['-metadata', f'{key}={value}']
+    return args
+
+def convert_audio(src_path, outputs, duration=None, progress_hook=None, tags=None, cover_path=None, cost=0):
+    """Produce every (dst_path, plan) output from a downloaded source in one FFmpeg pass.
+    
+    However many variants are requested the source is demuxed and decoded
+    once, and FFmpeg runs each output's encoder alongside the others. Tags and
+    cover art are written as ID3v2 to the tagged outputs in the same pass, so
+    a tagged file is never rewritten afterwards. FFmpeg's -progress output is
+    turned into 'converting' hook calls when the track duration is known.
+    FFmpeg starts when the scheduler gives the pass's cost its turn.
+    """
+    # Passthrough outputs are the source file itself, moved once FFmpeg is done reading it
+    passthrough = [dst for dst, plan in outputs if plan['pipeline'] == 'passthrough']
+    encoded = [(dst, plan) for dst, plan in outputs if plan['pipeline'] != 'passthrough']
+    error = None
+    if encoded:
+        pipeline = encoded[0][1]['pipeline']
+        cmd = [FFMPEG_BIN, '-nostdin', '-loglevel', 'error', '-y', '-progress', 'pipe:1', '-nostats',
+               '-i', src_path]
+        cover = bool(cover_path) and any(plan['tagged'] for _, plan in encoded)
+        if cover:
+            cmd += ['-i', cover_path]
+        for dst_path, plan in encoded:
+            cmd += output_args(plan, tags, cover) + [dst_path]
+        with ffmpeg_scheduler.slot(cost) as place:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    text=True)
+            place(proc)
+            for line in proc.stdout:
+                key, _, value = line.strip().partition('=')
+                if key == 'out_time_us' and value.isdigit() and duration and progress_hook:
+                    progress_hook({'status': 'converting',
+                                   'pipeline': pipeline,
+                                   'transcode_progress': min(100, round(int(value) / 1e4 / duration, 1))})
+            stderr = proc.stderr.read()
+            proc.wait()
+        if proc.returncode != 0:
+            error = RuntimeError(f"FFmpeg {pipeline} failed: {stderr.strip()}")
+    if passthrough and not error:
+        # More than one output can keep the source bytes, e.g. mp3 128k and 'original' of an MP3
+        for dst_path in passthrough[1:]:
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                shutil.copyfile(src_path, dst_path)
+        os.replace(src_path, passthrough[0])
+    else:
+        os.remove(src_path)
+    if error:
+        raise error
+
+class StdinFeeder(threading.Thread):
+    """Write chunks into a process's stdin from a thread, killing the process if a chunk fails"""
+    
+    def __init__(self, proc, chunks):
+        super().__init__(daemon=True)
+        self.proc = proc
+        self.chunks = chunks
+        self.error = None
+        self.start()
+    
+    def run(self):
+        stdin = self.proc.stdin
+        try:
+            for chunk in self.chunks:
+                # The pipe is in text mode for -progress output, so write to its byte buffer
+                getattr(stdin, 'buffer', stdin).write(chunk)
+        except BrokenPipeError:
+            pass  # FFmpeg exited early; its exit status says why
+        except Exception as e:
+            self.error = e
+            self.proc.kill()
+        finally:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+            try:
+                stdin.close()
+            except OSError:
+                pass
+
+def is_hls(fmt):
+    return (fmt.get('protocol') or '').startswith('m3u8')
+
+def hls_segments(fmt):
+    """Segment URLs of an HLS media playlist, or None if it needs yt-dlp (encrypted, live or a master playlist)"""
+    playlist = call_upstream(fetch_segment, fmt['url'], fmt.get('http_headers')).decode('utf-8', 'replace')
+    if not playlist.startswith('#EXTM3U') or '#EXT-X-ENDLIST' not in playlist:
+        return None
+    urls = []
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF') or (line.startswith('#EXT-X-KEY') and 'METHOD=NONE' not in line):
+            return None
+        if line.startswith('#EXT-X-MAP'):
+            # Initialization section of fragmented MP4, it goes first
+            uri = re.search(r'URI="([^"]+)"', line)
+            if uri:
+                urls.append(urljoin(fmt['url'], uri.group(1)))
+        elif line and not line.startswith('#'):
+            urls.append(urljoin(fmt['url'], line))
+    return urls or None
+
+def fetch_segment(url, headers=None):
+    """GET one HLS segment (or playlist) over the pooled session"""
+    response = http_session.get(url, headers=headers, timeout=15)
+    response.raise_for_status()
+    return response.content
+
+def iter_hls_segments(urls, headers=None, progress_hook=None, start=0, downloaded=0):
+    """Yield HLS segments in playlist order from `start` while up to FRAGMENT_CONCURRENCY are fetched ahead
+
+    `downloaded` is the size of the segments before `start`, for progress reports.
+    """
+    window = deque()
+    submitted = start
+    try:
+        while submitted < len(urls) or window:
+            while submitted < len(urls) and len(window) < FRAGMENT_CONCURRENCY:
+                window.append(io_executor.submit(call_upstream, fetch_segment, urls[submitted], headers,
+                                                 retries=FRAGMENT_RETRIES))
+                submitted += 1
+            data = window.popleft().result()
+            downloaded += len(data)
+            if progress_hook:
+                done = submitted - len(window)
+                progress_hook({'status': 'downloading',
+                               'downloaded_bytes': downloaded,
+                               'total_bytes_estimate': downloaded * len(urls) // done,
+                               'fragment_index': done,
+                               'fragment_count': len(urls)})
+            yield data
+    finally:
+        for future in window:
+            future.cancel()
+
+def hls_resume_point(src_path):
+    """Segments already in an HLS source file and their size, (0, 0) unless its record is intact"""
+    try:
+        with open(f"{src_path}.segments") as f:
+            done, size = (int(value) for value in f.read().split())
+        if os.path.getsize(src_path) >= size:
+            return done, size
+    except (OSError, ValueError):
+        pass
+    return 0, 0
+
+def save_hls_resume_point(src_path, done, size):
+    """Record that the first `done` segments, `size` bytes, of an HLS source file are complete"""
+    with open(f"{src_path}.segments", 'w') as f:
+        f.write(f"{done} {size}")
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-cleanup_thread.start()
+def id3_tags(info):
+    """ID3 text frames for a track; FFmpeg maps these keys to TIT2/TPE1/COMM"""
+    return {
+        'title': info.get('title'),
+        'artist': info.get('uploader'),
+        'comment': info.get('webpage_url')
+    }
 
-def download_soundcloud_track(url, track_id):
+def download_soundcloud_track(url, job_id, progress_hook=None, options=None):
     """Download SoundCloud track using yt-dlp"""
     try:
-        t0 = time.time()
-        audio_out = os.path.join(DOWNLOAD_DIR, f"{track_id}.%(ext)s")
+        options = options or DEFAULT_OPTIONS
+        # Metadata usually comes straight from the /info lookup cache
+        info = extract_track_info(url)
+        track_id = str(info['id'])
+        fmt = pick_source_format(info, options['format'], options['bitrate'])
+        requested = [plan_output(fmt, track_id, variant, options['tag'])
+                     for variant in [options] + options['variants']]
+        primary = requested[0]
+        
+        # Fetch the cover on the I/O pool while the audio downloads
+        thumbnail_url = cover_url_for(info)
+        cover_future = None
+        if thumbnail_url:
+            cover_future = io_executor.submit(inflight.do, f"cover:{thumbnail_url}", fetch_cover, thumbnail_url, job_id)
         
         ydl_opts = {
-            'format': 'bestaudio',
-            'outtmpl': audio_out,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '128',  # Lowered from 192 for faster conversion
-            }],
+            'format': fmt['format_id'],
+            # Keyed by track and format, so a .part left by a dropped connection is resumed by the
+            # next attempt, whichever job makes it
+            'outtmpl': os.path.join(TEMP_DIR, f"{track_id}-{fmt['format_id']}-src.%(ext)s"),
+            'fixup': 'never',  # Any container repair happens in our own remux
+            # Only used for HLS playlists our own segment fetcher can't handle
+            'concurrent_fragment_downloads': FRAGMENT_CONCURRENCY,
+            'fragment_retries': FRAGMENT_RETRIES,
+            'retries': 0,  # call_upstream retries instead, resuming the .part
+            # Keep the download time as mtime, not the CDN's Last-Modified: the temp sweep and the cache LRU go by it
+            'updatetime': False,
             'quiet': True,
             'noplaylist': True
         }
+        if progress_hook:
+            ydl_opts['progress_hooks'] = [progress_hook]
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-        t1 = time.time()
-        print(f"Audio download/conversion took {t1 - t0:.2f} seconds")
+        def tag_inputs(outputs):
+            """ID3 tags and cover path for the FFmpeg pass, or (None, None) when nothing is tagged"""
+            if not any(plan['tagged'] for _, plan in outputs):
+                return None, None
+            cover_for_tags = None
+            try:
+                cover_for_tags = cover_future.result()[1] if cover_future else None
+            except Exception as e:
+                print(f"Tagging without cover: {e}")
+            return id3_tags(info), cover_for_tags
+        
+        def fetch_audio():
+            paths = {}
+            missing = []
+            for plan in requested:
+                cached_path = track_cache.get(plan['file'])
+                cache_lookups.inc(kind='audio', result='hit' if cached_path else 'miss')
+                if cached_path:
+                    paths[plan['file']] = cached_path
+                else:
+                    missing.append(plan)
+            if not missing:
+                return paths, True
+            if any(plan['pipeline'] == 'transcode' for plan in missing):
+                # The source is decoded anyway, so each pre-warmed variant only adds an encoder
+                for variant in prewarm_variants:
+                    plan = plan_output(fmt, track_id, variant)
+                    if plan['file'] not in paths and plan not in missing and not track_cache.get(plan['file']):
+                        missing.append(plan)
+            outputs = [(os.path.join(TEMP_DIR, f"{job_id}-{index}.{plan['ext']}"), plan)
+                       for index, plan in enumerate(missing)]
+            pipeline = missing[0]['pipeline']
+            
+            def convert(src_path):
+                if progress_hook:
+                    progress_hook({'status': 'converting', 'pipeline': pipeline, 'transcode_progress': 0})
+                # Normally already done: the cover downloads alongside the audio
+                tags, cover_for_tags = tag_inputs(outputs)
+                with span('transcode', track_id=track_id, pipeline=pipeline, outputs=len(outputs)):
+                    convert_audio(src_path, outputs, duration=info.get('duration'), progress_hook=progress_hook,
+                                  tags=tags, cover_path=cover_for_tags,
+                                  cost=pass_cost(info, [plan['pipeline'] for plan in missing]))
+            
+            segments = hls_segments(fmt) if is_hls(fmt) else None
+            if segments:
+                # Segments download in parallel into one source file before the pass waits for
+                # an FFmpeg slot, so no slot sits idle on the network. Like yt-dlp's .part, the
+                # file is keyed by track and format, and the next attempt resumes it
+                src_path = os.path.join(TEMP_DIR, f"{track_id}-{fmt['format_id']}-src.{fmt.get('ext') or 'ts'}")
+                with state.lock(f"source:{track_id}-{fmt['format_id']}"):
+                    done, size = hls_resume_point(src_path)
+                    with span('download', track_id=track_id, format=fmt['format_id'], segments=len(segments),
+                              resumed=done), open(src_path, 'r+b' if done else 'wb') as source:
+                        source.truncate(size)
+                        source.seek(size)
+                        for data in iter_hls_segments(segments, fmt.get('http_headers'), progress_hook,
+                                                      start=done, downloaded=size):
+                            source.write(data)
+                            source.flush()
+                            done, size = done + 1, size + len(data)
+                            save_hls_resume_point(src_path, done, size)
+                    try:
+                        convert(src_path)
+                    finally:
+                        # The pass consumes the source, whatever its outcome
+                        try:
+                            os.remove(f"{src_path}.segments")
+                        except FileNotFoundError:
+                            pass
+            else:
+                import yt_dlp
+                
+                def download_source():
+                    try:
+                        # Metadata is already resolved, so skip loading extractors for this instance
+                        with yt_dlp.YoutubeDL(ydl_opts, auto_init=False) as ydl:
+                            # The cached info dict is shared, so let yt-dlp annotate a copy
+                            return ydl.process_ie_result(copy.deepcopy(info), download=True)
+                    except yt_dlp.utils.DownloadError as e:
+                        # yt-dlp reports dropped connections and 5xx without their cause, while
+                        # anything else (403, 404) carries the underlying error
+                        if not (e.exc_info and e.exc_info[1]):
+                            raise ConnectionError(f"Download interrupted: {e}") from e
+                        raise
+                
+                # The source file is shared by every job for this track until the FFmpeg pass consumes it
+                with state.lock(f"source:{track_id}-{fmt['format_id']}"):
+                    with span('download', track_id=track_id, format=fmt['format_id']):
+                        result = call_upstream(download_source)
+                    convert(result['requested_downloads'][0]['filepath'])
+            for temp_path, plan in outputs:
+                pipelines_total.inc(pipeline=plan['pipeline'])
+                paths[plan['file']] = track_cache.put(plan['file'], temp_path)
+            return paths, False
+        
+        # A cache hit skips download and transcode; concurrent requests for
+        # the same variants wait for one download
+        paths, cached = file_flight.do('+'.join(plan['file'] for plan in requested), fetch_audio)
         
         # Get track info
         title = info.get('title', 'Unknown Track')
-        thumbnail_url = info.get('thumbnail')
         
-        # Download cover image if available
         cover_path = None
         cover_ext = None
-        if thumbnail_url:
+        cover_file = None
+        if cover_future:
             try:
-                img_ext = thumbnail_url.split('.')[-1].split('?')[0]
-                if img_ext.lower() in ['jpg', 'jpeg', 'png', 'webp']:
-                    cover_ext = img_ext
-                else:
-                    cover_ext = 'jpg'
-                
-                cover_path = os.path.join(DOWNLOAD_DIR, f"{track_id}_cover.{cover_ext}")
-                response = requests.get(thumbnail_url, timeout=5)  # Lowered timeout from 30 to 5 seconds
-                response.raise_for_status()
-                
-                with open(cover_path, 'wb') as f:
-                    f.write(response.content)
+                # Time still spent on the cover once the audio is done
+                with span('cover_wait', track_id=track_id):
+                    cover_file, cover_path = cover_future.result()
+                cover_ext = cover_file.rsplit('.', 1)[-1]
             except Exception as e:
                 print(f"Error downloading cover: {e}")
-                cover_path = None
-                cover_ext = None
-        t2 = time.time()
-        print(f"Cover download took {t2 - t1:.2f} seconds")
-        
-        mp3_path = os.path.join(DOWNLOAD_DIR, f"{track_id}.mp3")
         
+        tracks_total.inc(result='finished')
         return {
             'success': True,
+            'track_id': track_id,
             'title': title,
-            'mp3_path': mp3_path,
+            'file': primary['file'],
+            'mp3_path': paths[primary['file']],
+            'variants': [{'format': plan['format'], 'bitrate': plan['bitrate'], 'file': plan['file']}
+                         for plan in requested],
+            'cover_file': cover_file,
             'cover_path': cover_path,
             'cover_ext': cover_ext,
-            'thumbnail_url': thumbnail_url
+            'thumbnail_url': thumbnail_url,
+            'pipeline': primary['pipeline'],
+            'tagged': primary['tagged'],
+            'cached': cached
         }
         
     except Exception as e:
+        tracks_total.inc(result='error')
         return {
             'success': False,
             'error': str(e)
         }
 
-@app.route('/')
-def index():
-    """Serve the frontend HTML"""
-    html_content = '''<!DOCTYPE html>
+def stream_transcode(fmt, pipeline, filename):
+    """Pipe the source stream through FFmpeg and yield MP3 bytes as they are encoded.
+    
+    With STREAM_TEE_TO_CACHE the output is also written to a temp file that is
+    moved into the track cache once FFmpeg exits cleanly.
+    """
+    segments = hls_segments(fmt) if is_hls(fmt) else None
+    headers = ''.join(f'{k}: {v}\r\n' for k, v in (fmt.get('http_headers') or {}).items())
+    cmd = [FFMPEG_BIN, '-nostdin', '-loglevel', 'error']
+    if headers and not segments:
+        cmd += ['-headers', headers]
+    # HLS is fetched by our parallel segment fetcher rather than FFmpeg's sequential one
+    cmd += ['-i', 'pipe:0' if segments else fmt['url'], '-vn']
+    # An mp3 source is copied through; anything else is encoded on the fly
+    cmd += ['-c:a', 'copy'] if pipeline != 'transcode' else ['-c:a', 'libmp3lame', '-b:a', f'{AUDIO_BITRATE}k']
+    cmd += ['-f', 'mp3', 'pipe:1']
+    
+    # Holds a transcode slot for as long as the client keeps reading
+    with transcodes.slot(), span('stream', pipeline=pipeline):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if segments else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        feeder = StdinFeeder(proc, iter_hls_segments(segments, fmt.get('http_headers'))) if segments else None
+        temp_path = os.path.join(TEMP_DIR, f"stream-{uuid.uuid4().hex[:8]}.{AUDIO_CODEC}")
+        tee = open(temp_path, 'wb') if STREAM_TEE_TO_CACHE else None
+        complete = False
+        try:
+            while True:
+                chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if tee:
+                    tee.write(chunk)
+                yield chunk
+            complete = proc.wait() == 0 and not (feeder and feeder.error)
+        finally:
+            # Reached on normal exit and when the client disconnects mid-stream
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            if feeder:
+                feeder.join()
+            proc.stdout.close()
+            if tee:
+                tee.close()
+                if complete:
+                    track_cache.put(filename, temp_path)
+                else:
+                    os.remove(temp_path)
+
+def send_cached_file(filename, download_name=None):
+    """Serve a cached artifact with a content-hash ETag, Range support and long caching.
+    
+    Werkzeug answers If-None-Match with 304 and Range with 206 once the
+    response is conditional; the ETag stays stable for as long as the bytes do.
+    With SERVE_MODE=x-accel-redirect or x-sendfile only headers are produced
+    here and the proxy streams the file (and handles Range) itself. Otherwise
+    the file stays pinned against eviction until the response has been sent.
+    """
+    if SERVE_MODE in ('x-accel-redirect', 'x-sendfile'):
+        file_path = track_cache.get(filename)
+        if not file_path:
+            return None
+        with span('serve', file=filename, mode=SERVE_MODE):
+            response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers['Content-Disposition'] = attachment_header(download_name or filename)
+            response.set_etag(track_cache.etag(filename))
+            response.cache_control.public = True
+            response.cache_control.max_age = FILE_MAX_AGE
+            response = response.make_conditional(request)
+        if response.status_code == 200:
+            # Only a full response hands the body to the proxy; a 304 must go out as it is
+            if SERVE_MODE == 'x-sendfile':
+                response.headers['X-Sendfile'] = os.path.abspath(file_path)
+            else:
+                response.headers['X-Accel-Redirect'] = f"{ACCEL_REDIRECT_PREFIX}/{quote(filename)}"
+            # Sent by the proxy, but still bytes this route served
+            served_bytes.inc(os.path.getsize(file_path), route='file')
+        return response
+    pin = ExitStack()
+    file_path = pin.enter_context(track_cache.pin(filename))
+    if not file_path:
+        pin.close()
+        return None
+    # Closed with the response, so the span covers sending the body
+    pin.enter_context(span('serve', file=filename, mode=SERVE_MODE))
+    response = send_file(os.path.abspath(file_path),
+                         as_attachment=True,
+                         download_name=download_name or filename,
+                         conditional=True,
+                         etag=track_cache.etag(filename),
+                         max_age=FILE_MAX_AGE)
+    response.cache_control.public = True
+    # mtime is the cache's LRU clock, so Last-Modified would change on every hit
+    response.headers.pop('Last-Modified', None)
+    if response.status_code in (200, 206):
+        served_bytes.inc(response.content_length or 0, route='file')
+    response.call_on_close(pin.close)
+    return response
+
+def attachment_header(name):
+    """Content-Disposition value that survives non-ASCII track titles"""
+    return f"attachment; filename*=UTF-8''{quote(name)}"
+
+# The frontend page; it has no template logic, so it is encoded and compressed once at import
+INDEX_HTML = '''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -346,8 +2784,12 @@ def index():
         .fetch-progress-inner {
             height: 100%;
             background: linear-gradient(90deg, #ff3c00 60%, #ffb199 100%);
-            width: 1%;
-            transition: width 0.3s;
+            width: 30%;
+            animation: indeterminate 1.2s ease-in-out infinite;
+        }
+        @keyframes indeterminate {
+            0% { transform: translateX(-100%); }
+            100% { transform: translateX(340%); }
         }
         @media (max-width: 600px) {
             .main-container {
@@ -407,7 +2849,6 @@ def index():
     </div>
     <script>
         let songData = null;
-        let fetchProgressInterval = null;
         function copyUrl() {
             const urlInput = document.getElementById('urlInput');
             urlInput.select();
@@ -438,34 +2879,91 @@ def index():
             document.getElementById('urlInput').value = '';
         }
         function animateFetchProgressBar() {
-            const bar = document.getElementById('fetchProgressBar');
-            const inner = document.getElementById('fetchProgressInner');
-            bar.style.display = 'block';
-            let progress = 1;
-            inner.style.width = progress + '%';
-            if (fetchProgressInterval) clearInterval(fetchProgressInterval);
-            fetchProgressInterval = setInterval(() => {
-                // Increase progress, slow down as it approaches 95%
-                if (progress < 80) {
-                    progress += Math.random() * 8 + 2;
-                } else if (progress < 95) {
-                    progress += Math.random() * 2 + 0.5;
-                } else {
-                    progress += Math.random() * 0.5;
-                }
-                if (progress > 99) progress = 99;
-                inner.style.width = progress + '%';
-            }, 180);
+            // Metadata lookups report no progress, so the bar is indeterminate
+            document.getElementById('fetchProgressBar').style.display = 'block';
         }
         function stopFetchProgressBar() {
-            const bar = document.getElementById('fetchProgressBar');
-            const inner = document.getElementById('fetchProgressInner');
-            if (fetchProgressInterval) clearInterval(fetchProgressInterval);
-            inner.style.width = '100%';
-            setTimeout(() => {
-                bar.style.display = 'none';
-                inner.style.width = '1%';
-            }, 400);
+            document.getElementById('fetchProgressBar').style.display = 'none';
+        }
+        function formatBytes(bytes) {
+            if (!bytes) return '0 KB';
+            return bytes >= 1048576 ? (bytes / 1048576).toFixed(1) + ' MB' : Math.round(bytes / 1024) + ' KB';
+        }
+        function describeProgress(job) {
+            if (job.status === 'converting') {
+                const pct = job.transcode_progress ? ` ${Math.round(job.transcode_progress)}%` : '';
+                return `Converting...${pct}`;
+            }
+            if (job.status === 'downloading' && job.downloaded_bytes) {
+                let label = `Downloading... ${formatBytes(job.downloaded_bytes)}`;
+                if (job.total_bytes) label += ` of ${formatBytes(job.total_bytes)}`;
+                if (job.speed) label += ` (${formatBytes(job.speed)}/s`;
+                if (job.speed && job.eta != null) label += `, ${job.eta}s left`;
+                if (job.speed) label += ')';
+                return label;
+            }
+            return job.status === 'queued' ? 'Waiting for a free worker...' : 'Downloading...';
+        }
+        function formatDuration(seconds) {
+            if (!seconds) return '';
+            const s = Math.round(seconds);
+            return Math.floor(s / 60) + ':' + String(s % 60).padStart(2, '0');
+        }
+        function watchJob(jobId, onUpdate) {
+            // Resolve once the job has finished or failed, following its event stream
+            return new Promise((resolve, reject) => {
+                if (!window.EventSource) {
+                    pollJob(jobId, onUpdate).then(resolve, reject);
+                    return;
+                }
+                const source = new EventSource(`/jobs/${jobId}/events`);
+                source.onmessage = event => {
+                    const job = JSON.parse(event.data);
+                    if (job.status === 'finished' || job.status === 'error') {
+                        source.close();
+                        resolve(job);
+                    } else if (onUpdate) {
+                        onUpdate(job);
+                    }
+                };
+                source.addEventListener('gone', () => {
+                    source.close();
+                    resolve({ success: false, error: 'Job expired' });
+                });
+                source.onerror = () => {
+                    // Stream dropped (proxy timeout etc.): fall back to polling
+                    source.close();
+                    pollJob(jobId, onUpdate).then(resolve, reject);
+                };
+            });
+        }
+        function pollJob(jobId, onUpdate) {
+            // Fallback for browsers or proxies without Server-Sent Events
+            return new Promise((resolve, reject) => {
+                const check = () => {
+                    fetch(`/jobs/${jobId}`)
+                    .then(res => res.json())
+                    .then(job => {
+                        if (job.status === 'finished' || job.status === 'error' || !job.success) {
+                            resolve(job);
+                        } else {
+                            if (onUpdate) onUpdate(job);
+                            setTimeout(check, 1000);
+                        }
+                    })
+                    .catch(reject);
+                };
+                check();
+            });
+        }
+        function isPlaylistUrl(url) {
+            // Sets and artist pages (soundcloud.com/artist) are downloaded as a ZIP
+            try {
+                const path = new URL(url.includes('://') ? url : 'https://' + url).pathname;
+                return path.includes('/sets/') || path.split('/').filter(Boolean).length === 1;
+            } catch (e) {
+                return false;
+            }
         }
         function fetchSong() {
             const url = document.getElementById('urlInput').value.trim();
@@ -493,7 +2991,9 @@ def index():
             document.getElementById('songListMeta').textContent = '';
             document.getElementById('songListDownloadBtn').disabled = true;
             animateFetchProgressBar();
-            fetch('/download', {
+            // Metadata only; the audio is fetched when the user clicks Download
+            const playlist = isPlaylistUrl(url);
+            fetch(playlist ? '/playlist/info' : '/info', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ url })
@@ -504,6 +3004,8 @@ def index():
                 stopFetchProgressBar();
                 if (data.success) {
                     songData = data;
+                    songData.url = url;
+                    songData.playlist = playlist;
                     // Show cover, title, meta
                     if (data.cover_url) {
                         document.getElementById('songCover').src = data.cover_url;
@@ -513,10 +3015,12 @@ def index():
                     }
                     document.getElementById('songTitle').textContent = data.title;
                     document.getElementById('songTitle').style.display = 'block';
-                    document.getElementById('songMeta').textContent = '';
+                    const meta = playlist ? `${data.track_count} tracks` : (data.uploader || '');
+                    document.getElementById('songMeta').textContent = meta;
                     document.getElementById('songMeta').style.display = 'block';
                     document.getElementById('songListTitle').textContent = data.title;
-                    document.getElementById('songListMeta').textContent = '';
+                    document.getElementById('songListMeta').textContent =
+                        playlist ? meta : formatDuration(data.duration);
                     document.getElementById('songListDownloadBtn').disabled = false;
                 } else {
                     showError(data.error || 'Failed to fetch track');
@@ -537,30 +3041,90 @@ def index():
             document.getElementById('finalButtons').style.display = 'none';
             document.getElementById('progressInner').style.width = '0%';
             document.getElementById('progressLabel').textContent = 'Downloading...';
-            // Simulate progress (since real progress is not available)
-            let progress = 0;
-            const interval = setInterval(() => {
-                progress += Math.random() * 20 + 10;
-                if (progress > 100) progress = 100;
-                document.getElementById('progressInner').style.width = progress + '%';
-                if (progress >= 100) {
-                    clearInterval(interval);
+            if (songData.playlist) {
+                startPlaylistDownload();
+                return;
+            }
+            fetch('/download', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                // Tagged: one self-contained MP3 with title, artist and artwork
+                body: JSON.stringify({ url: songData.url, tag: true })
+            })
+            .then(res => res.json())
+            .then(data => {
+                if (!data.success) return data;
+                return watchJob(data.job_id, job => {
+                    // Download fills the first 80% of the bar, conversion the rest
+                    const progress = job.status === 'converting'
+                        ? 80 + (job.transcode_progress || 0) * 0.2
+                        : (job.progress || 0) * 0.8;
+                    document.getElementById('progressInner').style.width = progress + '%';
+                    document.getElementById('progressLabel').textContent = describeProgress(job);
+                });
+            })
+            .then(job => {
+                if (job.success) {
+                    Object.assign(songData, job);
+                    document.getElementById('progressInner').style.width = '100%';
                     setTimeout(showFinalButtons, 400);
+                } else {
+                    showError(job.error || 'Failed to download track');
+                    resetUI();
                 }
-            }, 400);
+            })
+            .catch(() => {
+                showError('Network error. Please try again.');
+                resetUI();
+            });
+        }
+        function startPlaylistDownload() {
+            fetch('/playlist', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ url: songData.url, tag: true })
+            })
+            .then(res => res.json())
+            .then(data => {
+                if (!data.success) return data;
+                Object.assign(songData, data);
+                // The ZIP streams tracks as they finish, so start it immediately
+                window.location.href = songData.zip_url;
+                return watchJob(songData.job_id, job => {
+                    document.getElementById('progressInner').style.width = job.progress + '%';
+                    document.getElementById('progressLabel').textContent =
+                        `Downloaded ${job.completed} of ${songData.track_count} tracks...`;
+                });
+            })
+            .then(job => {
+                if (job.success) {
+                    document.getElementById('progressInner').style.width = '100%';
+                    setTimeout(showFinalButtons, 400);
+                } else {
+                    showError(job.error || 'Failed to download playlist');
+                    resetUI();
+                }
+            })
+            .catch(() => {
+                showError('Network error. Please try again.');
+                resetUI();
+            });
         }
         function showFinalButtons() {
+            const single = !songData.playlist;
+            document.getElementById('mp3Btn').style.display = single ? '' : 'none';
+            document.getElementById('coverBtn').style.display = single ? '' : 'none';
             document.getElementById('progressSection').style.display = 'none';
             document.getElementById('finalButtons').style.display = 'flex';
         }
         document.getElementById('mp3Btn').onclick = function() {
             if (songData) {
-                window.location.href = `/download_file/${songData.track_id}.mp3`;
+                window.location.href = `/download_file/${songData.file}`;
             }
         };
         document.getElementById('coverBtn').onclick = function() {
-            if (songData && songData.cover_ext) {
-                window.location.href = `/download_file/${songData.track_id}_cover.${songData.cover_ext}`;
+            if (songData && songData.cover_file) {
+                window.location.href = `/download_file/${songData.cover_file}`;
             }
         };
         document.getElementById('anotherBtn').onclick = function() {
@@ -579,9 +3143,124 @@ def index():
     </script>
 </body>
 </html>'''
-    return render_template_string(html_content)
+index_page = INDEX_HTML.encode()
+index_page_gzip = gzip.compress(index_page)
+index_etag = hashlib.sha256(index_page).hexdigest()[:16]
+
+@app.route('/')
+def index():
+    """Serve the frontend HTML, precompressed and cacheable"""
+    gzipped = request.accept_encodings.quality('gzip') > 0
+    response = Response(index_page_gzip if gzipped else index_page, mimetype='text/html')
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{index_etag}-gz" if gzipped else index_etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = INDEX_MAX_AGE
+    return response.make_conditional(request)
+
+def rate_limited(view):
+    """Answer 429 once the client IP has used up its token bucket"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        retry_after = rate_limiter.take(request.remote_addr)
+        if retry_after:
+            response = jsonify({'success': False, 'error': 'Too many requests, please slow down'})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+        return view(*args, **kwargs)
+    return wrapper
+
+def client_key():
+    """Who batch jobs count against for CLIENT_CONCURRENCY.
+    
+    That is the caller's address, or X-Client-Id when a gateway listed in
+    CLIENT_ID_PROXIES set it for the callers sharing the gateway's address.
+    """
+    # ProxyFix keeps the address of the peer that actually connected
+    peer = request.environ.get('werkzeug.proxy_fix.orig', {}).get('REMOTE_ADDR', request.remote_addr)
+    client_id = request.headers.get('X-Client-Id')
+    if client_id and peer in CLIENT_ID_PROXIES:
+        return f"id:{client_id}"
+    return request.remote_addr
+
+def overloaded():
+    """503 for work refused because the transcode queue is full"""
+    response = jsonify({'success': False, 'error': 'Server is busy, please retry shortly'})
+    response.headers['Retry-After'] = str(transcodes.retry_after())
+    return response, 503
+
+def needs_upstream(cached=None):
+    """Answer 503 at once while the circuit to SoundCloud is open, rather than queueing work bound to fail.
+    
+    Requests for which cached() is true are answered from the metadata and
+    file caches, so they go through whatever the circuit's state.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = upstream.retry_after()
+            if retry_after and not (cached and cached()):
+                response = jsonify({'success': False, 'error': 'SoundCloud is unavailable, please retry shortly'})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 503
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def info_cached():
+    if request.method == 'POST':
+        url = (request.get_json(silent=True) or {}).get('url', '')
+    else:
+        url = request.args.get('url', '')
+    return cached_info(url.strip()) is not None
+
+def download_cached():
+    data = request.get_json(silent=True) or {}
+    options, error = parse_output_options(data)
+    return not error and served_from_cache(data.get('url', '').strip(), options)
+
+def batch_cached():
+    data = request.get_json(silent=True) or {}
+    options, error = parse_output_options(data)
+    urls = data.get('urls')
+    if error or not isinstance(urls, list):
+        return False
+    return all(served_from_cache(url.strip(), options) for url in urls
+               if isinstance(url, str) and 'soundcloud.com' in url)
+
+def stream_cached():
+    return served_from_cache(request.args.get('url', '').strip())
+
+@app.route('/info', methods=['GET', 'POST'])
+@rate_limited
+@needs_upstream(info_cached)
+def info():
+    """Return track metadata without downloading the audio"""
+    try:
+        if request.method == 'POST':
+            url = (request.get_json(silent=True) or {}).get('url', '').strip()
+        else:
+            url = request.args.get('url', '').strip()
+        
+        if not url:
+            return jsonify({'success': False, 'error': 'URL is required'})
+        
+        if 'soundcloud.com' not in url:
+            return jsonify({'success': False, 'error': 'Please provide a valid SoundCloud URL'})
+        
+        track_info = summarize_info(extract_track_info(url))
+        track_info['success'] = True
+        track_info['cover_url'] = track_info['thumbnail_url']
+        return jsonify(track_info)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/download', methods=['POST'])
+@rate_limited
+@needs_upstream(download_cached)
 def download():
     """Handle download requests"""
     try:
@@ -594,34 +3273,282 @@ def download():
         if 'soundcloud.com' not in url:
             return jsonify({'success': False, 'error': 'Please provide a valid SoundCloud URL'})
         
-        # Generate unique track ID
-        track_id = str(uuid.uuid4())[:8]
+        options, error = parse_output_options(data)
+        if error:
+            return jsonify({'success': False, 'error': error})
         
-        # Download the track
-        result = download_soundcloud_track(url, track_id)
+        # Tracks already in the cache are only copied out, so they never wait for queue room
+        cached = served_from_cache(url, options)
+        if not cached and not transcodes.reserve():
+            return overloaded()
+        popularity.hit(url, options)
         
-        if result['success']:
-            response_data = {
-                'success': True,
-                'track_id': track_id,
-                'title': result['title'],
-                'cover_url': result['thumbnail_url'],
-                'cover_ext': result['cover_ext']
-            }
-            return jsonify(response_data)
-        else:
-            return jsonify({'success': False, 'error': result['error']})
+        # Queue the download, or join the job already fetching this URL
+        created = False
+        try:
+            job_id, created = create_job(url, options)
+            if created:
+                transcodes.submit(job_executor, run_download_job, job_id, url, options,
+                                  cost=0 if cached else job_cost(url, options), reserved=not cached)
+        finally:
+            if not created and not cached:
+                transcodes.unreserve()
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': f'/jobs/{job_id}'
+        }), 202
             
     except Exception as e:
         return jsonify({'success': False, 'error': f'Server error: {str(e)}'})
 
+@app.route('/batch', methods=['POST'])
+@rate_limited
+@needs_upstream(batch_cached)
+def batch():
+    """Queue many SoundCloud URLs at once"""
+    try:
+        data = request.get_json() or {}
+        urls = data.get('urls')
+        
+        if not isinstance(urls, list) or not urls:
+            return jsonify({'success': False, 'error': 'A non-empty list of URLs is required'})
+        
+        if len(urls) > BATCH_MAX_URLS:
+            return jsonify({'success': False, 'error': f'At most {BATCH_MAX_URLS} URLs per batch'})
+        
+        options, error = parse_output_options(data)
+        if error:
+            return jsonify({'success': False, 'error': error})
+        
+        items = []
+        pending = []  # Items of the valid URLs, which need a job
+        seen = set()
+        for url in urls:
+            url = url.strip() if isinstance(url, str) else ''
+            if 'soundcloud.com' not in url:
+                items.append({'url': url, 'status': 'invalid', 'progress': 100,
+                              'error': 'Please provide a valid SoundCloud URL'})
+                continue
+            key = normalize_url(url)
+            if key in seen:
+                continue
+            seen.add(key)
+            items.append({'url': url})
+            pending.append(items[-1])
+        
+        # Cached tracks run straight away; the rest wait in the client's own bounded queue
+        cached = {item['url'] for item in pending if served_from_cache(item['url'], options)}
+        uncached = len(pending) - len(cached)
+        client = client_key()
+        if uncached and transcodes.full():
+            return overloaded()
+        if not reserve_client_room(client, uncached):
+            return jsonify({'success': False, 'error': f'At most {CLIENT_QUEUE} tracks per client can wait to be downloaded'})
+        
+        try:
+            for item in pending:
+                # Jobs already queued or running for this URL are joined, not repeated
+                job_id, created = create_job(item['url'], options)
+                if created and item['url'] in cached:
+                    transcodes.submit(job_executor, run_download_job, job_id, item['url'], options)
+                elif created:
+                    submit_client_job(client, job_id, item['url'], options)
+                item.update(job_id=job_id, status='queued', reused=not created)
+        finally:
+            release_client_room(client, uncached)
+        
+        batch_id = str(uuid.uuid4())[:8]
+        state.set(f"batch:{batch_id}", {'client': client, 'created_at': time.time(), 'items': items})
+        
+        result = batch_status(batch_id)
+        result['success'] = True
+        result['status_url'] = f'/batch/{batch_id}'
+        return jsonify(result), 202
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Server error: {str(e)}'})
+
+@app.route('/batch/<batch_id>')
+def batch_status_view(batch_id):
+    """Report aggregate and per-item status of a batch"""
+    result = batch_status(batch_id)
+    if result is None:
+        return jsonify({'success': False, 'error': 'Batch not found'}), 404
+    result['success'] = True
+    return jsonify(result)
+
+@app.route('/stream')
+@rate_limited
+@needs_upstream(stream_cached)
+def stream():
+    """Transcode a track on the fly and stream the MP3 as it is produced"""
+    try:
+        url = request.args.get('url', '').strip()
+        
+        if not url:
+            return jsonify({'success': False, 'error': 'URL is required'}), 400
+        
+        if 'soundcloud.com' not in url:
+            return jsonify({'success': False, 'error': 'Please provide a valid SoundCloud URL'}), 400
+        
+        info = extract_track_info(url)
+        filename = cache_filename(str(info['id']))
+        download_name = f"{info.get('title', 'Unknown Track')}.{AUDIO_CODEC}"
+        
+        # Already transcoded: serve the cached file instead
+        response = send_cached_file(filename, download_name)
+        if response:
+            return response
+        
+        if transcodes.full():
+            return overloaded()
+        
+        fmt = pick_source_format(info)
+        pipeline, _ = plan_pipeline(fmt)
+        return Response(count_served(stream_transcode(fmt, pipeline, filename), 'stream'),
+                        mimetype='audio/mpeg',
+                        headers={'Content-Disposition': attachment_header(download_name),
+                                 'X-Pipeline': pipeline})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/playlist/info', methods=['GET', 'POST'])
+@rate_limited
+@needs_upstream()
+def playlist_info():
+    """List the tracks of a SoundCloud set or artist page without queueing them"""
+    try:
+        if request.method == 'POST':
+            url = (request.get_json(silent=True) or {}).get('url', '').strip()
+        else:
+            url = request.args.get('url', '').strip()
+        
+        if not url:
+            return jsonify({'success': False, 'error': 'URL is required'})
+        
+        if 'soundcloud.com' not in url:
+            return jsonify({'success': False, 'error': 'Please provide a valid SoundCloud URL'})
+        
+        title, entries = extract_playlist_entries(url)
+        if not entries:
+            return jsonify({'success': False, 'error': 'Playlist has no tracks'})
+        
+        return jsonify({'success': True, 'title': title, 'track_count': len(entries), 'tracks': entries})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/playlist', methods=['POST'])
+@rate_limited
+@needs_upstream()
+def playlist():
+    """Queue every track of a SoundCloud set or artist page"""
+    try:
+        data = request.get_json()
+        url = data.get('url', '').strip()
+        
+        if not url:
+            return jsonify({'success': False, 'error': 'URL is required'})
+        
+        if 'soundcloud.com' not in url:
+            return jsonify({'success': False, 'error': 'Please provide a valid SoundCloud URL'})
+        
+        options, error = parse_output_options(data)
+        if error:
+            return jsonify({'success': False, 'error': error})
+        
+        if transcodes.full():
+            return overloaded()
+        
+        title, entries = extract_playlist_entries(url)
+        if not entries:
+            return jsonify({'success': False, 'error': 'Playlist has no tracks'})
+        
+        # Tracks reach the shared queue PLAYLIST_CONCURRENCY at a time, see start_playlist_job()
+        tracks = [{'url': e['url'], 'title': e['title'], 'status': 'queued', 'progress': 0} for e in entries]
+        job_id, created = create_job(url, options, type='playlist', title=title, tracks=tracks,
+                                     completed=0, failed=0)
+        if created:
+            start_playlist_job(job_id, options)
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'title': title,
+            'track_count': len(tracks),
+            'status_url': f'/jobs/{job_id}',
+            'zip_url': f'/jobs/{job_id}/zip'
+        }), 202
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/jobs/<job_id>/zip')
+def job_zip(job_id):
+    """Stream a playlist job as a ZIP archive while its tracks finish"""
+    job = get_job(job_id)
+    if job is None or job.get('type') != 'playlist':
+        return jsonify({'success': False, 'error': 'Playlist job not found'}), 404
+    return Response(count_served(stream_playlist_zip(job_id), 'zip'),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': attachment_header(f"{job['title']}.zip")})
+
+def job_events(job_id):
+    """Yield Server-Sent Events for every change to a job until it completes"""
+    last_update = None
+    last_sent = time.time()
+    while True:
+        with status_lock:
+            job = get_job(job_id)
+            if job is not None and job['updated_at'] == last_update:
+                wait_for_job_change(SSE_KEEPALIVE)
+                job = get_job(job_id)
+        if job is None:
+            yield 'event: gone\ndata: {}\n\n'
+            return
+        if job['updated_at'] == last_update:
+            if time.time() - last_sent >= SSE_KEEPALIVE:
+                last_sent = time.time()
+                yield ': keepalive\n\n'
+            continue
+        last_update = job['updated_at']
+        last_sent = time.time()
+        job['success'] = job['status'] != 'error'
+        yield f"data: {json.dumps(job)}\n\n"
+        if job['status'] in ('finished', 'error'):
+            return
+
+@app.route('/jobs/<job_id>/events')
+def job_event_stream(job_id):
+    """Push job progress to the browser as Server-Sent Events"""
+    if get_job(job_id) is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return Response(job_events(job_id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the status of a queued download"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    job['success'] = job['status'] != 'error'
+    return jsonify(job)
+
 @app.route('/download_file/<filename>')
 def download_file(filename):
     """Serve downloaded files"""
     try:
-        file_path = os.path.join(DOWNLOAD_DIR, filename)
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
+        response = send_cached_file(filename)
+        if response:
+            # Range requests for the rest of a file are the same download
+            if request.range is None or request.range.ranges[0][0] == 0:
+                popularity.hit_file(filename)
+            return response
         else:
             return jsonify({'error': 'File not found'}), 404
     except Exception as e:
@@ -630,7 +3557,56 @@ def download_file(filename):
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    pipelines = {p: pipelines_total.get(pipeline=p) for p in ('passthrough', 'remux', 'transcode')}
+    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat(), 'pipelines': pipelines,
+                    'admission': transcodes.stats(), 'ffmpeg': ffmpeg_scheduler.stats(), 'upstream': upstream.stats(),
+                    'rate_limit': rate_limiter.stats()})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of this process's metrics"""
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def admin_only(view):
+    """Hide a view unless ADMIN_TOKEN is configured and sent in X-Admin-Token"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'success': False, 'error': 'Not found'}), 404
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/hot')
+@admin_only
+def hot_tracks():
+    """List the tracks the prefetcher keeps resident, hottest first"""
+    limit = request.args.get('limit', PREFETCH_TOP_N, type=int)
+    tracks = [{'url': entry['url'],
+               'options': entry['options'],
+               'score': round(score, 3),
+               'pinned': entry['pinned'],
+               'file': entry['file'],
+               'resident': bool(entry['file']) and os.path.exists(track_cache.path(entry['file']))}
+              for _, entry, score in popularity.top(limit)]
+    return jsonify({'success': True, 'tracks': tracks, 'prefetched': prefetcher.prefetched})
+
+@app.route('/admin/hot', methods=['POST'])
+@admin_only
+def pin_hot_track():
+    """Pin a track (url plus output options) so it is always prefetched, or unpin it with pinned=false"""
+    data = request.get_json() or {}
+    url = data.get('url', '').strip()
+    if 'soundcloud.com' not in url:
+        return jsonify({'success': False, 'error': 'Please provide a valid SoundCloud URL'}), 400
+    options, error = parse_output_options(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    entry = popularity.hit(url, options, pinned=bool(data.get('pinned', True)))
+    return jsonify({'success': True, 'url': entry['url'], 'options': entry['options'], 'pinned': entry['pinned']})
 
 @app.after_request
 def add_header(response):
@@ -641,7 +3617,8 @@ if __name__ == '__main__':
     print("🎵 SoundCloud Downloader Server Starting...")
     print(f"📁 Downloads will be saved to: {os.path.abspath(DOWNLOAD_DIR)}")
     print("🌐 Server will be available at: http://localhost:5000")
-    print("🧹 File cleanup: Files older than 1 hour will be automatically deleted")
+    print(f"🧹 File cleanup: Least recently used files are evicted above {CACHE_MAX_BYTES // 1024 ** 2} MB")
     
+    start_background_threads()
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
             
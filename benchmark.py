@@ -0,0 +1,492 @@
+"""Offline benchmark for the SoundCloud downloader.
+
+Runs a local stand-in for SoundCloud (track resolve API, progressive and HLS
+MP3 streams, artwork), starts the app against it under gunicorn and drives
+/download and /download_file at a given concurrency. Reports throughput,
+latency percentiles, CPU per track and peak RSS/disk, and appends the
+results to a JSON lines file so runs can be compared.
+
+    python benchmark.py --tracks 20 --requests 200 --concurrency 8
+
+App settings such as TRANSCODE_SLOTS or MAX_WORKERS are read from the
+environment as usual; rate limiting is switched off for the run. HLS
+sources are remuxed and --tag writes ID3 tags, both of which need FFmpeg;
+progressive MP3 passes straight through.
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MP3_FRAME_SECONDS = 1152 / 44100
+HLS_SEGMENT_SECONDS = 10
+
+def make_mp3(seconds):
+    """Silent MPEG-1 Layer III at 128 kbps, 44.1 kHz mono: valid input for yt-dlp and FFmpeg"""
+    # An all-zero side info and main data block decodes as silence
+    frame = b'\xff\xfb\x90\xc4' + bytes(413)
+    return frame * max(1, round(seconds / MP3_FRAME_SECONDS))
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Routes of the SoundCloud stand-in.
+
+    GET /resolve?url=...          track metadata with its media transcodings
+    GET /audio/<id>.mp3           progressive stream
+    GET /hls/<id>/playlist.m3u8   HLS playlist of MP3 segments
+    GET /hls/<id>/<n>.mp3         HLS segment
+    GET /artwork/<id>-<size>.jpg  cover art
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not server.bandwidth:
+            self.wfile.write(body)
+            return
+        chunk_size = 64 * 1024
+        for start in range(0, len(body), chunk_size):
+            self.wfile.write(body[start:start + chunk_size])
+            time.sleep(chunk_size / server.bandwidth)
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        path = parts.path.strip('/').split('/')
+        server.count(path[0])
+        if path == ['resolve']:
+            url = parse_qs(parts.query)['url'][0]
+            self.send_body(json.dumps(server.track(url)).encode(), 'application/json')
+        elif path[0] == 'audio':
+            self.send_body(server.audio, 'audio/mpeg')
+        elif path[0] == 'hls' and path[2] == 'playlist.m3u8':
+            self.send_body(server.playlist(path[1]).encode(), 'application/vnd.apple.mpegurl')
+        elif path[0] == 'hls':
+            self.send_body(server.segments[int(path[2].split('.')[0])], 'audio/mpeg')
+        elif path[0] == 'artwork':
+            track_id = path[1].split('-')[0]
+            # Distinct bytes per track, so covers are not all deduplicated into one file
+            self.send_body(b'\xff\xd8\xff\xe0' + track_id.encode() * 2000 + b'\xff\xd9', 'image/jpeg')
+        else:
+            self.send_error(404)
+
+class StandInSoundCloud(ThreadingHTTPServer):
+    """Local server answering the requests the app would make to SoundCloud"""
+
+    daemon_threads = True
+
+    def __init__(self, duration, sources, latency=0, bandwidth=0):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.duration = duration
+        self.sources = sources
+        self.latency = latency
+        self.bandwidth = bandwidth  # Bytes per second per response, 0 for unlimited
+        self.audio = make_mp3(duration)
+        frames_per_segment = round(HLS_SEGMENT_SECONDS / MP3_FRAME_SECONDS)
+        frame_size = len(make_mp3(MP3_FRAME_SECONDS))
+        step = frames_per_segment * frame_size
+        self.segments = [self.audio[i:i + step] for i in range(0, len(self.audio), step)]
+        self.lock = threading.Lock()
+        self.requests = {}  # route -> count
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, route):
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def track(self, url):
+        slug = urlsplit(url).path.rstrip('/').split('/')[-1]
+        track_id = str(zlib.crc32(slug.encode()))
+        media = []
+        if 'http' in self.sources:
+            media.append({'format_id': 'http_mp3_128', 'protocol': 'http', 'ext': 'mp3',
+                          'url': f'{self.base_url}/audio/{track_id}.mp3'})
+        if 'hls' in self.sources:
+            media.append({'format_id': 'hls_mp3_128', 'protocol': 'm3u8_native', 'ext': 'mp3',
+                          'url': f'{self.base_url}/hls/{track_id}/playlist.m3u8'})
+        return {
+            'id': track_id,
+            'title': f'Benchmark {slug}',
+            'user': 'benchmark',
+            'duration': self.duration,
+            'artwork_url': f'{self.base_url}/artwork/{track_id}-t500x500.jpg',
+            'media': media
+        }
+
+    def playlist(self, track_id):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{HLS_SEGMENT_SECONDS}',
+                 '#EXT-X-MEDIA-SEQUENCE:0']
+        for index, segment in enumerate(self.segments):
+            seconds = len(segment) / len(self.audio) * self.duration
+            lines += [f'#EXTINF:{seconds:.3f},', f'{self.base_url}/hls/{track_id}/{index}.mp3']
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+class StandInExtractor:
+    """Stands in for the app's YoutubeDL extractor: resolves tracks against the stand-in"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def extract_info(self, url, download=False):
+        response = self.session.get(f'{self.base_url}/resolve', params={'url': url}, timeout=30)
+        response.raise_for_status()
+        track = response.json()
+        formats = [{
+            'format_id': m['format_id'],
+            'url': m['url'],
+            'ext': m['ext'],
+            'protocol': m['protocol'],
+            'acodec': 'mp3',
+            'vcodec': 'none',
+            'abr': 128
+        } for m in track['media']]
+        return {
+            'id': track['id'],
+            'title': track['title'],
+            'uploader': track['user'],
+            'duration': track['duration'],
+            'webpage_url': url,
+            'extractor': 'soundcloud',
+            'extractor_key': 'Soundcloud',
+            'thumbnails': [{'id': 't500x500', 'url': track['artwork_url']}],
+            'thumbnail': track['artwork_url'],
+            'formats': formats,
+            'format_id': formats[0]['format_id']
+        }
+
+def create_app():
+    """gunicorn factory: the app with extraction pointed at the stand-in from BENCH_STANDIN_URL"""
+    sys.path.insert(0, REPO_DIR)
+    import app as service
+    # The app pools the stand-ins as it would its own YoutubeDL instances
+    service.new_extractor = lambda kind='track': StandInExtractor(os.environ['BENCH_STANDIN_URL'])
+    return service.app
+
+def process_tree(root_pid):
+    """PIDs of a process and all its descendants (Linux /proc only)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, todo = [], [root_pid]
+    while todo:
+        pid = todo.pop()
+        pids.append(pid)
+        todo.extend(children.get(pid, []))
+    return pids
+
+def tree_cpu_seconds(root_pid):
+    """User+system CPU of a process tree, including its reaped children such as FFmpeg runs"""
+    ticks = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        ticks += sum(int(v) for v in fields[11:15])  # utime, stime, cutime, cstime
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+def tree_rss_bytes(root_pid):
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+def dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def percentile(values, pct):
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))]
+
+def summarize(values):
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99),
+            'max': max(values) if values else None}
+
+def start_app(args, standin_url, workdir):
+    env = dict(os.environ, BENCH_STANDIN_URL=standin_url, RATE_LIMIT_PER_MINUTE='0')
+    cmd = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{args.port}', '--workers', str(args.workers),
+           '--worker-class', args.worker_class, '--pythonpath', REPO_DIR,
+           '--timeout', '600', '--log-level', 'warning', 'benchmark:create_app()']
+    if args.worker_class == 'gthread':
+        cmd[-1:-1] = ['--threads', str(args.threads)]
+    # The app keeps its cache in ./downloads, so each run starts cold in its own directory
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL if args.quiet else None)
+    base_url = f'http://127.0.0.1:{args.port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('App exited during startup')
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).ok:
+                return proc, base_url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('App did not become healthy within 30 seconds')
+
+def run_request(session, base_url, url, args, sample):
+    """One track end to end: queue the download, wait for the job, fetch the file"""
+    started = time.perf_counter()
+    while True:
+        body = {'url': url, 'format': args.format, 'bitrate': args.bitrate, 'tag': args.tag}
+        response = session.post(f'{base_url}/download', json=body, timeout=30)
+        if response.status_code not in (429, 503):
+            break
+        # Backpressure from admission control: honour it, but keep the run moving
+        sample['rejected'] += 1
+        time.sleep(min(float(response.headers.get('Retry-After', 1)), 5))
+    data = response.json()
+    if not data.get('success'):
+        raise RuntimeError(data.get('error'))
+    status_url = f"{base_url}{data['status_url']}"
+    while True:
+        job = session.get(status_url, timeout=30).json()
+        if job['status'] in ('finished', 'error'):
+            break
+        time.sleep(args.poll_interval)
+    if job['status'] == 'error':
+        raise RuntimeError(job.get('error'))
+    queued = time.perf_counter()
+    size = 0
+    with session.get(f"{base_url}/download_file/{job['file']}", stream=True, timeout=30) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(64 * 1024):
+            size += len(chunk)
+    finished = time.perf_counter()
+    sample['job'].append(queued - started)
+    sample['serve'].append(finished - queued)
+    sample['total'].append(finished - started)
+    sample['bytes'] += size
+    sample['cached'] += bool(job.get('cached'))
+
+def run_load(args, base_url, app_pid, workdir):
+    rng = random.Random(args.seed)
+    urls = [f'https://soundcloud.com/benchmark/track-{i:04d}' for i in range(args.tracks)]
+    work = queue.Queue()
+    for i in range(args.requests):
+        # Every track once first, then random repeats that should be cache hits
+        work.put(urls[i] if i < len(urls) else rng.choice(urls))
+    sample = {'job': [], 'serve': [], 'total': [], 'bytes': 0, 'cached': 0, 'rejected': 0, 'errors': []}
+    lock = threading.Lock()
+    peaks = {'rss': 0, 'disk': 0}
+    done = threading.Event()
+
+    def worker():
+        session = requests.Session()
+        local = {'job': [], 'serve': [], 'total': [], 'bytes': 0, 'cached': 0, 'rejected': 0}
+        while True:
+            try:
+                url = work.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                run_request(session, base_url, url, args, local)
+            except Exception as e:
+                with lock:
+                    sample['errors'].append(str(e))
+        with lock:
+            for key, value in local.items():
+                sample[key] += value
+
+    def sampler():
+        downloads = os.path.join(workdir, 'downloads')
+        while not done.is_set():
+            peaks['rss'] = max(peaks['rss'], tree_rss_bytes(app_pid))
+            peaks['disk'] = max(peaks['disk'], dir_bytes(downloads))
+            done.wait(args.sample_interval)
+
+    monitor = threading.Thread(target=sampler, daemon=True)
+    monitor.start()
+    cpu_before = tree_cpu_seconds(app_pid)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    cpu = tree_cpu_seconds(app_pid) - cpu_before
+    done.set()
+    monitor.join()
+
+    completed = len(sample['total'])
+    return {
+        'wall_seconds': round(wall, 3),
+        'completed': completed,
+        'errors': len(sample['errors']),
+        'error_samples': sample['errors'][:5],
+        'cache_hits': sample['cached'],
+        'rejected': sample['rejected'],
+        'throughput_per_s': round(completed / wall, 3) if wall else None,
+        'latency': {phase: summarize(sample[phase]) for phase in ('total', 'job', 'serve')},
+        'cpu_seconds_per_track': round(cpu / completed, 4) if completed else None,
+        'peak_rss_mb': round(peaks['rss'] / 1024 ** 2, 1),
+        'peak_disk_mb': round(peaks['disk'] / 1024 ** 2, 1),
+        'served_mb': round(sample['bytes'] / 1024 ** 2, 1)
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_result(path, scenario):
+    """Latest stored run of the same scenario, or None"""
+    if not os.path.exists(path):
+        return None
+    match = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('scenario') == scenario:
+                match = record
+    return match
+
+def report(results, previous):
+    def delta(new, old, lower_is_better=True):
+        if new is None or not old:
+            return ''
+        change = (new - old) / old * 100
+        worse = change > 0 if lower_is_better else change < 0
+        return f"  ({change:+.1f}% vs {previous['git_rev'] or 'previous'}{', REGRESSION' if worse and abs(change) > 10 else ''})"
+
+    old = previous['results'] if previous else {}
+    print(f"completed {results['completed']} tracks in {results['wall_seconds']}s, "
+          f"{results['errors']} errors, {results['cache_hits']} cache hits, {results['rejected']} rejected")
+    print(f"throughput      {results['throughput_per_s']} tracks/s"
+          f"{delta(results['throughput_per_s'], old.get('throughput_per_s'), lower_is_better=False)}")
+    for phase, stats in results['latency'].items():
+        old_stats = old.get('latency', {}).get(phase, {})
+        for pct in ('p50', 'p95', 'p99'):
+            value = stats[pct]
+            print(f"{phase:<6} {pct:<8} {value * 1000 if value is not None else float('nan'):.1f} ms"
+                  f"{delta(value, old_stats.get(pct))}")
+    print(f"cpu per track   {results['cpu_seconds_per_track']} s"
+          f"{delta(results['cpu_seconds_per_track'], old.get('cpu_seconds_per_track'))}")
+    print(f"peak rss        {results['peak_rss_mb']} MB{delta(results['peak_rss_mb'], old.get('peak_rss_mb'))}")
+    print(f"peak disk       {results['peak_disk_mb']} MB")
+    for error in results['error_samples']:
+        print(f"error: {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tracks', type=int, default=20, help='Distinct tracks in the workload')
+    parser.add_argument('--requests', type=int, default=100, help='Downloads to run; beyond --tracks they repeat')
+    parser.add_argument('--concurrency', type=int, default=8, help='Clients downloading at once')
+    parser.add_argument('--duration', type=float, default=180, help='Seconds of audio per track')
+    parser.add_argument('--sources', default='http,hls', help='Stream kinds the stand-in offers: http, hls or both')
+    parser.add_argument('--format', default='mp3', choices=('mp3', 'opus', 'aac', 'original'))
+    parser.add_argument('--bitrate', help="Output bitrate in kbps (the app's default for the format if omitted)")
+    parser.add_argument('--tag', action='store_true', help='Request ID3 tags (needs FFmpeg)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay the stand-in adds to every response')
+    parser.add_argument('--bandwidth-kbps', type=float, default=0, help='Per-response stand-in bandwidth, 0 = unlimited')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn worker processes')
+    parser.add_argument('--worker-class', default='gevent', choices=('gevent', 'gthread'),
+                        help='gunicorn worker class; gevent is what gunicorn.conf.py deploys')
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn threads per gthread worker')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--poll-interval', type=float, default=0.02)
+    parser.add_argument('--sample-interval', type=float, default=0.25)
+    parser.add_argument('--results', default=os.path.join(REPO_DIR, 'benchmark_results.jsonl'),
+                        help='JSON lines file results are appended to and compared against')
+    parser.add_argument('--label', help='Free-form note stored with the results')
+    parser.add_argument('--quiet', action='store_true', help="Hide the app's own output")
+    args = parser.parse_args()
+
+    sources = sorted(s.strip() for s in args.sources.split(','))
+    standin = StandInSoundCloud(args.duration, sources, args.latency_ms / 1000, args.bandwidth_kbps * 1024 / 8)
+    threading.Thread(target=standin.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix='scdl-bench-')
+    proc = None
+    try:
+        proc, base_url = start_app(args, standin.base_url, workdir)
+        results = run_load(args, base_url, proc.pid, workdir)
+    finally:
+        if proc:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=30)
+        standin.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    results['upstream_requests'] = standin.requests
+
+    scenario = {
+        'tracks': args.tracks, 'requests': args.requests, 'concurrency': args.concurrency,
+        'duration': args.duration, 'sources': sources, 'format': args.format, 'tag': args.tag,
+        'latency_ms': args.latency_ms, 'bandwidth_kbps': args.bandwidth_kbps,
+        'workers': args.workers, 'worker_class': args.worker_class,
+        # App settings that change the outcome
+        'env': {k: os.environ[k] for k in ('MAX_WORKERS', 'TRANSCODE_SLOTS', 'TRANSCODE_QUEUE', 'STATE_BACKEND',
+                                           'CACHE_MAX_BYTES', 'SERVE_MODE', 'FRAGMENT_CONCURRENCY', 'FFMPEG_SLOTS',
+                                           'PREWARM_VARIANTS')
+                if k in os.environ}
+    }
+    if args.bitrate:
+        scenario['bitrate'] = args.bitrate
+    if args.worker_class == 'gthread':
+        scenario['threads'] = args.threads
+    previous = previous_result(args.results, scenario)
+    report(results, previous)
+    record = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'git_rev': git_revision(),
+              'label': args.label, 'scenario': scenario, 'results': results}
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Contract check for the shared state store backends.
+
+Runs the same checks against SQLiteStore (a temporary file) and RedisStore
+(REDIS_URL, or fakeredis when no server answers there), including expiry
+surviving update() and a job whose worker died being failed rather than
+reused. Exits non-zero on the first failure.
+
+    python check_stores.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+# The app creates its downloads directory relative to the working directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix='scdl-check-'))
+
+import app
+
+def check_store(store):
+    store.set('k', {'n': 1})
+    assert store.get('k') == {'n': 1}
+    assert not store.add('k', {'n': 2})
+    assert store.add('fresh', 'x', ttl=60)
+
+    assert store.update('k', lambda value: value.update(n=2) or 'ok') == 'ok'
+    assert store.get('k') == {'n': 2}
+    assert store.update('missing', lambda value: 'ran') is None
+
+    # update() must keep a key's expiry, not make it permanent
+    store.set('short', {'n': 1}, ttl=1)
+    store.update('short', lambda value: value.update(n=2))
+    assert store.get('short') == {'n': 2}
+    time.sleep(1.2)
+    assert store.get('short') is None, 'update() dropped the TTL'
+    assert store.add('short', {'n': 3})
+
+    store.delete('k', expected={'n': 1})
+    assert store.get('k') == {'n': 2}, 'delete() ignored expected'
+    store.delete('k', expected={'n': 2})
+    assert store.get('k') is None
+
+    store.set('scan:a', 1)
+    store.set('scan:b', 2)
+    assert store.scan('scan:') == {'scan:a': 1, 'scan:b': 2}
+
+    with store.lock('check', ttl=5):
+        assert not store.add('lock:check', 'other')
+    assert store.add('lock:check', 'other')
+
+def check_orphans(store):
+    """A queued job of a worker that stopped heartbeating is failed, and the next request starts afresh"""
+    app.state = store
+    url = 'https://soundcloud.com/artist/orphan'
+    job_id, created = app.create_job(url)
+    assert created
+    store.update(f"job:{job_id}", lambda job: job.update(owner='elsewhere:1:dead'))
+
+    again, created = app.create_job(url)
+    assert created and again != job_id, 'a dead worker\'s job was reused'
+    assert store.get(f"job:{job_id}")['status'] == 'error'
+
+    # A live worker's job is still shared
+    store.set('worker:elsewhere:2:live', {}, ttl=60)
+    store.update(f"job:{again}", lambda job: job.update(owner='elsewhere:2:live'))
+    assert app.create_job(url) == (again, False)
+
+def redis_store():
+    store = app.RedisStore(app.REDIS_URL, namespace='scdl-check:')
+    try:
+        store.redis.ping()
+        print(f"redis: {app.REDIS_URL}")
+    except Exception:
+        import fakeredis
+        store = app.RedisStore(client=fakeredis.FakeRedis(), namespace='scdl-check:')
+        print('redis: fakeredis')
+    for key in store.redis.scan_iter(match='scdl-check:*'):
+        store.redis.delete(key)
+    return store
+
+def main():
+    backends = [('sqlite', lambda: app.SQLiteStore(os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))),
+                ('redis', redis_store)]
+    for name, make in backends:
+        try:
+            store = make()
+        except ImportError as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        check_store(store)
+        check_orphans(store)
+        print(f"{name}: ok")
+
+if __name__ == '__main__':
+    try:
+        main()
+    except AssertionError as e:
+        print(f"FAILED: {e}")
+        sys.exit(1)
@@ -0,0 +1,20 @@
+"""Gunicorn settings for app:app.
+
+gevent workers serve each connection from a greenlet, so thousands of idle
+SSE progress streams and slow /stream clients don't each hold a sync worker
+or thread; the CPU work happens in FFmpeg subprocesses anyway.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 2000))  # Connections per gevent worker
+# Job status lives in process memory unless STATE_BACKEND shares it, so only then scale out
+workers = int(os.environ.get('WEB_CONCURRENCY', 2)) if os.environ.get('STATE_BACKEND', 'memory') != 'memory' else 1
+timeout = 120  # Downloads and transcodes run off the request greenlets, so this only bounds a stuck request
+keepalive = 5
+
+def post_worker_init(worker):
+    """Start the app's background threads as soon as the worker has loaded it, not on its first request"""
+    import app
+    app.start_background_threads()